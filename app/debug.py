@@ -1,8 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 
+from app import recommend
+from app.recommender import catalog
 from app.sql import crud, schemas
-from app.utils import dependencies
+from app.utils import dependencies, memory
+from app.utils.config import settings
 
 router = APIRouter(prefix="/debug", tags=["debug"])
 
@@ -58,3 +61,30 @@ def read_playlists(
 ):
     album = crud.get_playlists(db, skip, limit)
     return album
+
+
+# Memory Debug
+
+
+@router.get("/memory")
+def read_memory_usage():
+    return {**memory.memory_usage(), "snapshot_mmap": settings.snapshot_mmap}
+
+
+# Catalog Debug
+
+
+@router.get("/catalog")
+def read_catalog_status():
+    song_index, album_index = catalog.song_index, catalog.album_index
+    return {
+        "songs": len(song_index) if song_index is not None else 0,
+        "albums": len(album_index) if album_index is not None else 0,
+        "loaded_at": catalog.loaded_at,
+        "reloading": catalog.reloading,
+    }
+
+
+@router.post("/catalog/reload", status_code=202)
+def reload_catalog():
+    return {"started": recommend.start_catalog_reload()}
@@ -3,6 +3,8 @@ from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 
+from app.recommend import require_catalog
+from app.recommender import catalog, taste
 from app.sql import crud, models, schemas
 from app.utils import dependencies
 
@@ -17,6 +19,35 @@ def get_friends(
     return crud.get_user(db, current_user.id).friends
 
 
+@router.get(
+    "/compatibility",
+    response_model=list[schemas.FriendCompatibility],
+    dependencies=[Depends(require_catalog)],
+)
+def get_friend_compatibility(
+    current_user: Annotated[models.User, Depends(dependencies.get_current_user)],
+    db: Session = Depends(dependencies.get_db),
+):
+    friends = crud.get_user(db, current_user.id).friends
+    ids = [friend.id for friend in friends]
+    profiles = crud.get_taste_profiles(db, [current_user.id, *ids])
+    scores = taste.similarities(
+        profiles[current_user.id],
+        [profiles[id] for id in ids],
+        *catalog.song_index.statistics(),
+    )
+    overlaps = crud.get_starred_overlaps(db, current_user.id, ids)
+    return [
+        {
+            "id": friend.id,
+            "username": friend.username,
+            "taste_similarity": score,
+            "starred_overlap": overlaps[friend.id],
+        }
+        for friend, score in zip(friends, scores)
+    ]
+
+
 @router.post("/send/{id}", response_model=schemas.FriendRequest)
 def send_friend_request(
     current_user: Annotated[models.User, Depends(dependencies.get_current_user)],
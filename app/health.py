@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from app.recommender import catalog
+
+router = APIRouter(prefix="/health", tags=["health"])
+
+
+@router.get("/live")
+def read_liveness():
+    return {"status": "ok"}
+
+
+@router.get("/ready")
+def read_readiness():
+    ready = catalog.song_index is not None
+    status = {
+        "ready": ready,
+        "stage": catalog.STAGES[catalog.stage],
+        "step": catalog.stage,
+        "steps": len(catalog.STAGES) - 1,
+        "reloading": catalog.reloading,
+        "error": catalog.failure,
+    }
+    return JSONResponse(status, status_code=200 if ready else 503)
@@ -4,6 +4,7 @@ from app.albums import router as albums_router
 from app.auth import router as auth_router
 from app.debug import router as debug_router
 from app.friends import router as friends_router
+from app.health import router as health_router
 from app.playlists import router as playlists_router
 from app.recommend import recommend_lifespan
 from app.recommend import router as recommend_router
@@ -15,6 +16,7 @@ from app.utils.config import settings
 models.Base.metadata.create_all(bind=database.engine)
 
 app = FastAPI(lifespan=recommend_lifespan)
+app.include_router(health_router)
 app.include_router(auth_router)
 app.include_router(friends_router)
 app.include_router(songs_router)
@@ -1,45 +1,84 @@
+import hashlib
 from contextlib import asynccontextmanager
-from functools import lru_cache
-from typing import Annotated
+from typing import Annotated, Literal
 
-import pandas as pd
-from fastapi import APIRouter, Depends, FastAPI, HTTPException
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Response
 from sqlalchemy.orm import Session
 
-from app.sql import crud, models, schemas
+from app.recommender import (
+    batcher,
+    cache,
+    catalog,
+    collaborative,
+    engine,
+    snapshot,
+    taste,
+)
+from app.sql import crud, database, models, schemas
 from app.utils import dependencies
 from app.utils.config import settings
 
-router = APIRouter(prefix="/recommend", tags=["recommend"])
-default_songs = []
 
+def require_catalog():
+    if catalog.song_index is None:
+        raise HTTPException(
+            status_code=503,
+            detail="The song catalog is still loading",
+            headers={"Retry-After": str(settings.catalog_retry_after)},
+        )
 
-@asynccontextmanager
-async def recommend_lifespan(app: FastAPI):
-    global default_songs
-    print("INFO:     Loading songs from csv.. Might take a second.")
-    na = ["", "NaN"]
-    default_songs = pd.concat(
-        (
-            pd.read_csv(file, na_values=na, keep_default_na=False)
-            for file in settings.songfiles
-        ),
-        ignore_index=True,
+
+router = APIRouter(
+    prefix="/recommend", tags=["recommend"], dependencies=[Depends(require_catalog)]
+)
+Aggregate = Literal["centroid", "mean", "max"]
+RecommendCount = Annotated[int, Query(ge=1, le=schemas.RECOMMEND_LIMIT)]
+# Least misery ranks by the lowest similarity to any member's taste, average
+# by the mean of their similarities
+GroupStrategy = Literal["least_misery", "average"]
+
+
+def read_user_catalog():
+    with database.SessionLocal() as db:
+        return crud.get_all_user_songs(db), crud.get_all_user_albums(db)
+
+
+def read_database_catalog(kind: str) -> dict:
+    model = models.Song if kind == "songs" else models.Album
+    with database.SessionLocal() as db:
+        count, id_length = crud.get_feature_row_count(db, model)
+        return snapshot.from_rows(count, id_length, crud.stream_feature_rows(db, model))
+
+
+def read_collection_songs() -> tuple[np.ndarray, np.ndarray]:
+    with database.SessionLocal() as db:
+        return collaborative.pairs(crud.stream_collection_songs(db))
+
+
+def start_catalog_reload() -> bool:
+    """Reloads the catalog from the configured source in the background."""
+    if settings.catalog_source == "database":
+        return catalog.start_reload(
+            catalog.reload_database, read_database_catalog, read_user_catalog
+        )
+    return catalog.start_reload(
+        catalog.reload,
+        settings.songfiles,
+        settings.snapshot_dir,
+        settings.snapshot_mmap,
+        read_user_catalog,
     )
-    print("INFO:     Done!")
-    yield
 
 
-# This takes longer
 @asynccontextmanager
-async def recommend_lifespan_with_query(app: FastAPI):
-    global default_songs
-    print("INFO:     Loading songs from csv.. Might take a while.")
-    with dependencies.get_db() as db:
-        default_songs = crud.get_all_defualt_songs(db)
-        print("INFO:     Done!")
-        yield
+async def recommend_lifespan(app: FastAPI):
+    # Served while the catalog loads, /health/ready reports its progress
+    print(f"INFO:     Loading catalog from {settings.catalog_source} in background.")
+    start_catalog_reload()
+    if settings.collaborative_interval > 0:
+        collaborative.schedule(read_collection_songs, settings.collaborative_interval)
+    yield
 
 
 def get_features_from_model(model: models.Song | models.Album):
@@ -79,182 +118,581 @@ def get_features_from_models(models: list[models.Song] | list[models.Album]):
     return features
 
 
-@lru_cache
-def get_features_from_df():
-    features = default_songs[
-        [
-            "danceability",
-            "speechiness",
-            "acousticness",
-            "instrumentalness",
-            "liveness",
-            "valence",
-            "tempo",
-            "loudness",
-            "mode",
-            "key",
-        ]
-    ]
-    return features
+def get_filters(filters: schemas.RecommendFilters) -> dict:
+    """Returns the attribute filters in the form SongIndex.search takes."""
+    index_filters = {
+        name: getattr(filters, name)
+        for name in ["explicit", "key", "mode", "time_signature"]
+        if getattr(filters, name) is not None
+    }
+    if filters.year_min is not None or filters.year_max is not None:
+        index_filters["year"] = (filters.year_min, filters.year_max)
+    return index_filters
+
+
+def get_excluded_ids(
+    db: Session, filters: schemas.RecommendFilters, user: models.User | None
+) -> list[str]:
+    if not filters.exclude_starred and not filters.exclude_playlists:
+        return []
+    if user is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Sign in to exclude starred or playlist songs",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
 
+    ids = []
+    if filters.exclude_starred:
+        ids += crud.get_starred_song_ids(db, user.id)
+    if filters.exclude_playlists:
+        ids += crud.get_playlist_song_ids_by_owner_id(db, user.id)
+    return ids
 
-@router.get("/song/{id}", response_model=list[schemas.Song])
-def recommend_song_from_song(
-    id: str,
-    recommend: int = 10,
-    db: Session = Depends(dependencies.get_db),
+
+def get_or_rank(
+    tag: tuple, params: tuple, filters: schemas.RecommendFilters | None, rank
 ):
-    song = crud.get_song_by_id(db, id)
-    if not song:
-        raise HTTPException(status_code=404, detail="Invalid song id: " + id)
+    if filters is None:
+        return cache.recommendations.get_or_compute(tag, params, rank)
+    # Excluded songs change with the user's library, which is not a cache tag
+    if filters.exclude_starred or filters.exclude_playlists:
+        return rank()
+    index_filters = tuple(sorted(get_filters(filters).items()))
+    return cache.recommendations.get_or_compute(tag, params + index_filters, rank)
+
+
+def get_page(
+    response: Response,
+    tag: tuple,
+    params: tuple,
+    filters: schemas.RecommendFilters | None,
+    page: schemas.RecommendPage,
+    recommend: int,
+    rank,
+) -> list[str]:
+    """Returns the ids rank(count, minimum) ranks, recommend of them at a time.
+
+    Without paging they are ranked and cached like before. The first page
+    ranks recommend_page_depth songs and keeps them under a cursor, which
+    later pages with the same parameters and filters slice instead of ranking
+    again. The cursor of the next page is sent in the X-Next-Cursor header
+    while any songs are left.
+    """
+    # Cursors only serve requests ranking the same list as the first page
+    cursor_tag = tag + params
+    if filters is not None:
+        cursor_tag += tuple(sorted(filters.model_dump().items()))
+
+    if page.cursor:
+        found = cache.cursors.read(page.cursor, cursor_tag)
+        if found is None:
+            raise HTTPException(
+                status_code=400,
+                detail="Cursor expired, invalid or made for other parameters",
+            )
+        key, ids, offset = found
+    elif page.paginate:
+        depth = max(recommend, settings.recommend_page_depth)
+        ids = get_or_rank(
+            tag, (depth, "pages") + params, filters, lambda: rank(depth, 0)
+        )
+        if len(ids) < recommend:
+            raise HTTPException(
+                status_code=404,
+                detail="Could not find the required amount of recommendation(s)",
+            )
+        key, offset = cache.cursors.create(cursor_tag, ids), 0
+    else:
+        return get_or_rank(tag, (recommend,) + params, filters, rank)
+
+    end = offset + recommend
+    if key is not None and end < len(ids):
+        response.headers["X-Next-Cursor"] = f"{key}.{end}"
+    return ids[offset:end]
+
+
+def rank_songs(
+    seeds: list[models.Song],
+    recommend: int,
+    aggregate: Aggregate = "centroid",
+    filters: dict | None = None,
+    excluded_ids: list[str] | None = None,
+    minimum: int | None = None,
+) -> list[str]:
+    """Returns the ids of the catalog songs closest to the seeds, best first."""
+    queries = engine.normalize(get_features_from_models(seeds))
+    return rank_queries(
+        queries,
+        [seed.id for seed in seeds],
+        recommend,
+        aggregate,
+        filters,
+        excluded_ids,
+        minimum,
+    )
+
+
+def rank_queries(
+    queries: np.ndarray,
+    seed_ids: list[str],
+    recommend: int,
+    aggregate: str = "centroid",
+    filters: dict | None = None,
+    excluded_ids: list[str] | None = None,
+    minimum: int | None = None,
+) -> list[str]:
+    """Returns the ids of the catalog songs closest to the queries, best first.
+
+    The seeds the queries were computed from are never recommended. Fewer
+    than recommend songs are a 404 unless at least minimum were found.
+    """
+    minimum = recommend if minimum is None else minimum
+    song_index = catalog.song_index
+    seed_rows = song_index.get_rows(seed_ids) if song_index else []
+    not_found = HTTPException(
+        status_code=404,
+        detail="Could not find the required amount of recommendation(s)",
+    )
+
+    if song_index is None or len(song_index) < len(seed_rows) + minimum:
+        raise not_found
+
+    if len(seed_rows) == 1 and len(queries) == 1 and not filters and not excluded_ids:
+        result = song_index.lookup(seed_rows[0], recommend)
+        if result is not None:
+            return song_index.get_ids(result[0])
+
+    if excluded_ids:
+        seed_rows = np.union1d(seed_rows, song_index.get_rows(excluded_ids))
+    if len(queries) == 1 and not filters:
+        rows, _ = batcher.queries.search(song_index, queries[0], recommend, seed_rows)
+    else:
+        rows, _ = song_index.search(queries, recommend, seed_rows, aggregate, filters)
+    if len(rows) < minimum:
+        raise not_found
+    return song_index.get_ids(rows)
+
+
+def rank_song_batch(rows: list[int], recommends: list[int]) -> list[list[str]]:
+    """Returns the ids of the catalog songs closest to each seed row, best first.
+
+    Seeds answered by the neighbour table skip scoring, the others are scored
+    together with one matrix product per chunk of the catalog.
+    """
+    song_index = catalog.song_index
+    k = max(recommends)
+    if len(song_index) < k + 1:
+        raise HTTPException(
+            status_code=404,
+            detail="Could not find the required amount of recommendation(s)",
+        )
 
-    if song.owner_id != 0:
+    results = [song_index.lookup(row, k) for row in rows]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if pending:
+        queries = song_index.get_features([rows[i] for i in pending])
+        excludes = [[rows[i]] for i in pending]
+        for i, result in zip(pending, song_index.search_many(queries, k, excludes)):
+            results[i] = result
+
+    ranked = []
+    for (found, _), recommend in zip(results, recommends):
+        if len(found) < recommend:
+            raise HTTPException(
+                status_code=404,
+                detail="Could not find the required amount of recommendation(s)",
+            )
+        ranked.append(song_index.get_ids(found[:recommend]))
+    return ranked
+
+
+def rank_collaborative(
+    song: models.Song,
+    recommend: int,
+    weight: float,
+    filters: dict | None = None,
+    excluded_ids: list[str] | None = None,
+    minimum: int | None = None,
+) -> list[str]:
+    """Returns the ids of the songs starred or listed together with song, best first.
+
+    Below a weight of 1 the co-occurrence similarities are blended with audio
+    similarity, over the best collaborative_candidates songs of each.
+    """
+    if settings.collaborative_interval <= 0:
         raise HTTPException(
             status_code=400,
-            detail="User registered songs are incompatible for recommendation",
+            detail="Collaborative recommendations are disabled",
+        )
+    similarities = collaborative.similarities
+    if similarities is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Collaborative recommendations are still building",
+            headers={"Retry-After": str(settings.catalog_retry_after)},
+        )
+
+    song_index = catalog.song_index
+    depth = max(recommend, settings.collaborative_candidates)
+    exclude = [song.id, *(excluded_ids or [])]
+    ids, scores = similarities.similar(
+        song.id, recommend if weight == 1 and not filters else depth, exclude
+    )
+    if filters:
+        # Songs outside the catalog have no attributes to filter on
+        rows = song_index.get_rows(ids)
+        passed = set(song_index.get_ids(rows[song_index.passes(rows, filters)]))
+        kept = [i for i, id in enumerate(ids) if id in passed]
+        ids, scores = [ids[i] for i in kept], scores[kept]
+    collaborative_scores = dict(zip(ids, scores))
+
+    if weight == 1:
+        ranked = ids[:recommend]
+    else:
+        if not catalog.has_features(song):
+            raise HTTPException(
+                status_code=400,
+                detail="Song has no audio features for recommendation",
+            )
+        query = engine.normalize(get_features_from_model(song))[0]
+        exclude_rows = song_index.get_rows(exclude)
+        rows, audio = song_index.search(query, depth, exclude_rows, filters=filters)
+        audio_scores = dict(zip(song_index.get_ids(rows), audio))
+        rows = song_index.get_rows(list(ids))
+        audio_scores.update(
+            zip(song_index.get_ids(rows), song_index.get_features(rows) @ query)
+        )
+        ranked = collaborative.blend(
+            audio_scores, collaborative_scores, weight, recommend
         )
 
-    target_song_features = get_features_from_model(song)
-    all_song_features = get_features_from_df()
+    if len(ranked) < (recommend if minimum is None else minimum):
+        raise HTTPException(
+            status_code=404,
+            detail="Could not find the required amount of recommendation(s)",
+        )
+    return ranked
 
-    similarities = cosine_similarity(target_song_features, all_song_features)[0]
 
-    recommendations = []
+def rank_albums(
+    album: models.Album, recommend: int, minimum: int | None = None
+) -> list[str]:
+    """Returns the ids of the catalog albums closest to album, best first."""
+    album_index = catalog.album_index
+    album_rows = album_index.get_rows([album.id]) if album_index else []
+    minimum = recommend if minimum is None else minimum
 
-    if len(similarities) < 1 + recommend:
+    if album_index is None or len(album_index) < len(album_rows) + minimum:
         raise HTTPException(
             status_code=404,
             detail="Could not find the required amount of recommendation(s)",
         )
 
-    for i in range(recommend):
-        similarities[similarities.argmax()] = -1
-        # max_similarity = similarities.max()
-        recommended_song_id = default_songs.loc[similarities.argmax(), "id"]
+    query = engine.normalize(get_features_from_model(album))
+    rows, _ = album_index.search(query, recommend, album_rows)
+    return album_index.get_ids(rows)
 
-        recommendations.append(crud.get_song_by_id(db, recommended_song_id))
 
-    return recommendations
+@router.get("/cache")
+def read_cache_stats():
+    return cache.recommendations.stats()
 
 
-@router.get("/album/{id}", response_model=list[schemas.Song])
-def recommend_song_from_album(
+@router.get("/song/{id}", response_model=list[schemas.Song])
+def recommend_song_from_song(
     id: str,
-    recommend: int = 10,
+    current_user: Annotated[
+        models.User | None, Depends(dependencies.get_optional_user)
+    ],
+    response: Response,
+    recommend: RecommendCount = 10,
+    collaborative_weight: Annotated[float, Query(ge=0, le=1)] = 0,
+    filters: schemas.RecommendFilters = Depends(),
+    page: schemas.RecommendPage = Depends(),
     db: Session = Depends(dependencies.get_db),
 ):
-    album = crud.get_album_by_id(db, id)
-    if not album:
-        raise HTTPException(status_code=404, detail="Album not found")
+    excluded_ids = get_excluded_ids(db, filters, current_user)
+
+    def rank(recommend: int = recommend, minimum: int | None = None):
+        song = crud.get_song_by_id(db, id)
+        if not song:
+            raise HTTPException(status_code=404, detail="Invalid song id: " + id)
+
+        if collaborative_weight > 0:
+            return rank_collaborative(
+                song,
+                recommend,
+                collaborative_weight,
+                get_filters(filters),
+                excluded_ids,
+                minimum,
+            )
+
+        if not catalog.has_features(song):
+            raise HTTPException(
+                status_code=400,
+                detail="Song has no audio features for recommendation",
+            )
+
+        return rank_songs(
+            [song],
+            recommend,
+            filters=get_filters(filters),
+            excluded_ids=excluded_ids,
+            minimum=minimum,
+        )
+
+    params = ()
+    if collaborative_weight > 0:
+        params = (collaborative_weight, collaborative.version)
+    ids = get_page(response, ("song", id), params, filters, page, recommend, rank)
+    return crud.get_songs_by_ids(db, ids)
 
-    if album.owner_id != 0:
+
+@router.post("/songs", response_model=list[schemas.RecommendBatchResult])
+def recommend_songs_from_songs(
+    batch: schemas.RecommendBatch,
+    db: Session = Depends(dependencies.get_db),
+):
+    ids = [seed.id for seed in batch.seeds]
+    rows = [catalog.song_index.get_rows([id]) for id in ids]
+
+    # Only seeds outside the catalog are read, to tell why they are
+    missing = [id for id, found in zip(ids, rows) if not len(found)]
+    if missing:
+        known = {song.id for song in crud.get_songs_by_ids(db, missing)}
+        for id in missing:
+            if id not in known:
+                raise HTTPException(status_code=404, detail="Invalid song id: " + id)
         raise HTTPException(
             status_code=400,
-            detail="User registered songs are incompatible for recommendation",
+            detail="Song has no audio features for recommendation: " + missing[0],
         )
 
-    tracks = crud.get_songs_by_album_id(db, id)
-    if not tracks:
-        raise HTTPException(status_code=404, detail="Album is empty")
+    ranked = rank_song_batch(
+        [found[0] for found in rows], [seed.recommend for seed in batch.seeds]
+    )
+    songs = {
+        song.id: song
+        for song in crud.get_songs_by_ids(db, list({id for r in ranked for id in r}))
+    }
+    return [
+        {"id": id, "songs": [songs[song_id] for song_id in result if song_id in songs]}
+        for id, result in zip(ids, ranked)
+    ]
 
-    target_song_features = get_features_from_models(tracks)
-    all_song_features = get_features_from_df()
 
-    similarities = cosine_similarity(target_song_features, all_song_features)[0]
+@router.get("/album/{id}", response_model=list[schemas.Song])
+def recommend_song_from_album(
+    id: str,
+    current_user: Annotated[
+        models.User | None, Depends(dependencies.get_optional_user)
+    ],
+    response: Response,
+    recommend: RecommendCount = 10,
+    aggregate: Aggregate = "centroid",
+    filters: schemas.RecommendFilters = Depends(),
+    page: schemas.RecommendPage = Depends(),
+    db: Session = Depends(dependencies.get_db),
+):
+    excluded_ids = get_excluded_ids(db, filters, current_user)
+
+    def rank(recommend: int = recommend, minimum: int | None = None):
+        album = crud.get_album_by_id(db, id)
+        if not album:
+            raise HTTPException(status_code=404, detail="Album not found")
+
+        tracks = crud.get_songs_by_album_id(db, id)
+        if not tracks:
+            raise HTTPException(status_code=404, detail="Album is empty")
+
+        tracks = [track for track in tracks if catalog.has_features(track)]
+        if not tracks:
+            raise HTTPException(
+                status_code=404,
+                detail="There is no song with audio features in this album",
+            )
+
+        return rank_songs(
+            tracks, recommend, aggregate, get_filters(filters), excluded_ids, minimum
+        )
 
-    recommendations = []
+    ids = get_page(
+        response, ("album", id), (aggregate,), filters, page, recommend, rank
+    )
+    return crud.get_songs_by_ids(db, ids)
 
-    if len(similarities) < len(tracks) + recommend:
-        raise HTTPException(
-            status_code=404,
-            detail="Could not find the required amount of recommendation(s)",
-        )
 
-    for i in range(recommend):
-        similarities[similarities.argmax()] = -1
-        # max_similarity = similarities.max()
-        recommended_song_id = default_songs.loc[similarities.argmax(), "id"]
+@router.get("/album/{id}/albums", response_model=list[schemas.Album])
+def recommend_album_from_album(
+    id: str,
+    response: Response,
+    recommend: RecommendCount = 10,
+    page: schemas.RecommendPage = Depends(),
+    db: Session = Depends(dependencies.get_db),
+):
+    def rank(recommend: int = recommend, minimum: int | None = None):
+        album = crud.get_album_by_id(db, id)
+        if not album:
+            raise HTTPException(status_code=404, detail="Album not found")
+
+        if not catalog.has_features(album):
+            raise HTTPException(
+                status_code=400,
+                detail="Album has no audio features for recommendation",
+            )
 
-        recommendations.append(crud.get_song_by_id(db, recommended_song_id))
+        return rank_albums(album, recommend, minimum)
 
-    return recommendations
+    ids = get_page(response, ("albums", id), (), None, page, recommend, rank)
+    return crud.get_albums_by_ids(db, ids)
 
 
 @router.get("/playlist/{id}", response_model=list[schemas.Song])
 def recommend_song_from_playlist(
     id: int,
-    recommend: int = 10,
+    current_user: Annotated[
+        models.User | None, Depends(dependencies.get_optional_user)
+    ],
+    response: Response,
+    recommend: RecommendCount = 10,
+    aggregate: Aggregate = "centroid",
+    filters: schemas.RecommendFilters = Depends(),
+    page: schemas.RecommendPage = Depends(),
     db: Session = Depends(dependencies.get_db),
 ):
-    playlist = crud.get_playlist_by_id(db, id)
-    if not playlist:
-        raise HTTPException(status_code=404, detail="Playlist not found")
-
-    tracks = [track for track in playlist.songs if track.owner_id == 0]
-
-    if not tracks:
-        raise HTTPException(
-            status_code=404,
-            detail="There is no non-user register song in this playlist",
-        )
+    excluded_ids = get_excluded_ids(db, filters, current_user)
 
-    target_song_features = get_features_from_models(tracks)
-    all_song_features = get_features_from_df()
+    def rank(recommend: int = recommend, minimum: int | None = None):
+        playlist = crud.get_playlist_by_id(db, id)
+        if not playlist:
+            raise HTTPException(status_code=404, detail="Playlist not found")
 
-    similarities = cosine_similarity(target_song_features, all_song_features)[0]
+        tracks = [track for track in playlist.songs if catalog.has_features(track)]
 
-    recommendations = []
+        if not tracks:
+            raise HTTPException(
+                status_code=404,
+                detail="There is no song with audio features in this playlist",
+            )
 
-    if len(similarities) < len(tracks) + recommend:
-        raise HTTPException(
-            status_code=404,
-            detail="Could not find the required amount of recommendation(s)",
+        return rank_songs(
+            tracks, recommend, aggregate, get_filters(filters), excluded_ids, minimum
         )
 
-    for i in range(recommend):
-        similarities[similarities.argmax()] = -1
-        # max_similarity = similarities.max()
-        recommended_song_id = default_songs.loc[similarities.argmax(), "id"]
-
-        recommendations.append(crud.get_song_by_id(db, recommended_song_id))
-
-    return recommendations
+    ids = get_page(
+        response, ("playlist", id), (aggregate,), filters, page, recommend, rank
+    )
+    return crud.get_songs_by_ids(db, ids)
 
 
 @router.get("/starred", response_model=list[schemas.Song])
 def recommend_song_from_starred(
     current_user: Annotated[models.User, Depends(dependencies.get_current_user)],
-    recommend: int = 10,
+    response: Response,
+    recommend: RecommendCount = 10,
+    aggregate: Aggregate = "centroid",
+    filters: schemas.RecommendFilters = Depends(),
+    page: schemas.RecommendPage = Depends(),
     db: Session = Depends(dependencies.get_db),
 ):
-    starred = crud.get_starred(db, current_user.id)
-
-    tracks = [track for track in starred.songs if track.owner_id == 0]
+    excluded_ids = get_excluded_ids(db, filters, current_user)
+
+    def rank(recommend: int = recommend, minimum: int | None = None):
+        if aggregate == "max":
+            starred = crud.get_starred(db, current_user.id)
+            tracks = [track for track in starred.songs if catalog.has_features(track)]
+            if tracks:
+                return rank_songs(
+                    tracks,
+                    recommend,
+                    aggregate,
+                    get_filters(filters),
+                    excluded_ids,
+                    minimum,
+                )
+        else:
+            # Mean scores rank like centroid ones, both use the taste vector
+            centroid = taste.centroid(crud.get_taste_profile(db, current_user.id))
+            if centroid is not None:
+                return rank_queries(
+                    centroid[np.newaxis],
+                    crud.get_starred_song_ids(db, current_user.id),
+                    recommend,
+                    filters=get_filters(filters),
+                    excluded_ids=excluded_ids,
+                    minimum=minimum,
+                )
 
-    if not tracks:
         raise HTTPException(
             status_code=404,
-            detail="There is no non-user register song starred",
+            detail="There is no song with audio features starred",
         )
 
-    target_song_features = get_features_from_models(tracks)
-    all_song_features = get_features_from_df()
-
-    similarities = cosine_similarity(target_song_features, all_song_features)[0]
+    ids = get_page(
+        response,
+        ("starred", current_user.id),
+        (aggregate,),
+        filters,
+        page,
+        recommend,
+        rank,
+    )
+    return crud.get_songs_by_ids(db, ids)
 
-    recommendations = []
 
-    if len(similarities) < len(tracks) + recommend:
+@router.get("/group", response_model=list[schemas.Song])
+def recommend_song_for_group(
+    current_user: Annotated[models.User, Depends(dependencies.get_current_user)],
+    response: Response,
+    users: Annotated[list[int], Query(max_length=20)] = [],
+    recommend: RecommendCount = 10,
+    strategy: GroupStrategy = "least_misery",
+    filters: schemas.RecommendFilters = Depends(),
+    page: schemas.RecommendPage = Depends(),
+    db: Session = Depends(dependencies.get_db),
+):
+    friend_ids = {friend.id for friend in crud.get_user(db, current_user.id).friends}
+    for id in users:
+        if id != current_user.id and id not in friend_ids:
+            raise HTTPException(status_code=400, detail=f"Not friends with user: {id}")
+
+    members = sorted({current_user.id, *users})
+    profiles = crud.get_taste_profiles(db, members)
+    centroids = [taste.centroid(profiles[id]) for id in members]
+    centroids = [centroid for centroid in centroids if centroid is not None]
+    if not centroids:
         raise HTTPException(
             status_code=404,
-            detail="Could not find the required amount of recommendation(s)",
+            detail="There is no song with audio features starred",
         )
 
-    for i in range(recommend):
-        similarities[similarities.argmax()] = -1
-        # max_similarity = similarities.max()
-        recommended_song_id = default_songs.loc[similarities.argmax(), "id"]
-
-        recommendations.append(crud.get_song_by_id(db, recommended_song_id))
+    # Every member's taste is scored against the catalog in one pass
+    queries = np.stack(centroids)
+    aggregate = "min" if strategy == "least_misery" else "mean"
+    excluded_ids = get_excluded_ids(db, filters, current_user)
+
+    def rank(recommend: int = recommend, minimum: int | None = None):
+        return rank_queries(
+            queries,
+            crud.get_starred_song_ids_by_owner_ids(db, members),
+            recommend,
+            aggregate,
+            get_filters(filters),
+            excluded_ids,
+            minimum,
+        )
 
-    return recommendations
+    # Tastes change with every star, so they are part of the key
+    digest = hashlib.sha256(queries.tobytes()).hexdigest()
+    ids = get_page(
+        response,
+        ("group", *members),
+        (strategy, digest),
+        filters,
+        page,
+        recommend,
+        rank,
+    )
+    return crud.get_songs_by_ids(db, ids)
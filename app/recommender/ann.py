@@ -0,0 +1,106 @@
+import numpy as np
+
+from app.recommender import engine
+
+
+def assign(features: np.ndarray, centroids: np.ndarray, chunk: int = 65536):
+    """Returns the index of the most similar centroid for every row."""
+    labels = np.empty(len(features), dtype=np.int32)
+    for start in range(0, len(features), chunk):
+        block = features[start : start + chunk] @ centroids.T
+        labels[start : start + chunk] = block.argmax(axis=1)
+    return labels
+
+
+def kmeans(features: np.ndarray, n: int, iterations: int = 10, seed: int = 0):
+    """Spherical k-means: returns n unit length centroids of the rows."""
+    rng = np.random.default_rng(seed)
+    centroids = features[rng.choice(len(features), n, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign(features, centroids)
+        sums = np.stack(
+            [np.bincount(labels, column, minlength=n) for column in features.T],
+            axis=1,
+        )
+        empty = ~sums.any(axis=1)
+        # Restart clusters that lost all their rows from random rows
+        sums[empty] = features[rng.choice(len(features), empty.sum())]
+        centroids = engine.normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    """Inverted file index: rows grouped into lists by their nearest centroid.
+
+    A search only scores the rows of the nprobe lists whose centroids are most
+    similar to the query, trading some recall for scanning a fraction of the
+    catalog.
+    """
+
+    def __init__(self, centroids: np.ndarray, rows: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.rows = rows
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, features: np.ndarray, n_lists: int = 0, sample: int = 64):
+        """Clusters features into n_lists lists, about sqrt(rows) when 0.
+
+        The centroids are trained on at most sample rows per list.
+        """
+        n_lists = n_lists or int(np.sqrt(len(features)))
+        n_lists = max(1, min(n_lists, len(features)))
+
+        rng = np.random.default_rng(0)
+        training = features
+        if len(features) > n_lists * sample:
+            training = features[
+                np.sort(rng.choice(len(features), n_lists * sample, replace=False))
+            ]
+        centroids = kmeans(np.asarray(training), n_lists)
+
+        labels = assign(features, centroids)
+        rows = np.argsort(labels, kind="stable").astype(np.int32)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+        return cls(centroids, rows, offsets)
+
+    def candidates(
+        self, queries: np.ndarray, nprobe: int, aggregate: str = "centroid"
+    ) -> np.ndarray:
+        """Returns the sorted rows of the nprobe lists closest to the queries."""
+        nprobe = min(nprobe, len(self.centroids))
+        lists, _ = engine.top_k(
+            engine.score(self.centroids, queries, aggregate), nprobe
+        )
+        return np.sort(
+            np.concatenate(
+                [self.rows[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+            )
+        )
+
+    def search(
+        self,
+        features: np.ndarray,
+        queries: np.ndarray,
+        k: int,
+        nprobe: int,
+        exclude=(),
+        aggregate: str = "centroid",
+        mask: np.ndarray | None = None,
+    ):
+        """Returns the rows and scores of the best k rows among the probed lists.
+
+        Only rows set in mask are considered when it is given. Returns None
+        when the probed lists hold fewer than k usable rows.
+        """
+        candidates = self.candidates(queries, nprobe, aggregate)
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        skip = np.flatnonzero(np.isin(candidates, exclude))
+        if len(candidates) - len(skip) < k:
+            return None
+
+        scores = engine.score(features[candidates], queries, aggregate)
+        positions, scores = engine.top_k(scores, k, skip)
+        return candidates[positions], scores
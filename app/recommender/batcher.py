@@ -0,0 +1,73 @@
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+from app.recommender import index
+from app.utils.config import settings
+
+
+class QueryBatcher:
+    """Collects concurrent single query searches and runs them as one batch.
+
+    The first request to arrive leads the batch: it waits up to window
+    seconds, or until max_size requests are queued, then searches for all of
+    them with SongIndex.search_many and hands every request its own result.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self.pending: list[tuple] = []
+        self.leading = False
+        self.lock = threading.Lock()
+        self.full = threading.Condition(self.lock)
+
+    def search(self, song_index: index.SongIndex, query: np.ndarray, k: int, exclude):
+        if self.window <= 0 or self.max_size <= 1:
+            return song_index.search(query, k, exclude)
+
+        future = Future()
+        with self.lock:
+            self.pending.append((song_index, query, k, exclude, future))
+            if len(self.pending) >= self.max_size:
+                self.full.notify()
+            leader = not self.leading
+            self.leading = True
+
+        if leader:
+            with self.lock:
+                self.full.wait_for(
+                    lambda: len(self.pending) >= self.max_size, self.window
+                )
+                batch, self.pending = self.pending, []
+                self.leading = False
+            self.run(batch)
+        return future.result()
+
+    def run(self, batch: list):
+        # The index can be swapped while a batch is collected
+        groups: dict[int, list] = {}
+        for item in batch:
+            groups.setdefault(id(item[0]), []).append(item)
+
+        for items in groups.values():
+            song_index = items[0][0]
+            k = max(item[2] for item in items)
+            try:
+                results = song_index.search_many(
+                    np.stack([item[1] for item in items]),
+                    k,
+                    [item[3] for item in items],
+                )
+            except BaseException as e:
+                for item in items:
+                    item[4].set_exception(e)
+                continue
+            for item, (rows, scores) in zip(items, results):
+                item[4].set_result((rows[: item[2]], scores[: item[2]]))
+
+
+queries = QueryBatcher(
+    settings.recommend_batch_window_ms / 1000, settings.recommend_batch_size
+)
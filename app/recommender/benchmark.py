@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from app.recommender import engine, index
+
+SIZES = [100_000, 1_000_000, 10_000_000]
+MODES = ["exact", "ivf", "int16", "int8"]
+QUERIES = ["single", "multi", "filtered", "batched"]
+
+
+def synthetic(n: int, seed: int = 0) -> np.ndarray:
+    """Returns n rows of raw features distributed roughly like the catalog."""
+    rng = np.random.default_rng(seed)
+    columns = {
+        "danceability": rng.beta(5, 4, n),
+        "speechiness": rng.beta(1, 12, n),
+        "acousticness": rng.beta(1, 2, n),
+        "instrumentalness": rng.beta(0.3, 1.5, n),
+        "liveness": rng.beta(2, 10, n),
+        "valence": rng.beta(2, 2, n),
+        "tempo": rng.normal(118, 30, n).clip(0, 250),
+        "loudness": rng.normal(-11, 6, n).clip(-60, 5),
+        "mode": rng.integers(0, 2, n),
+        "key": rng.integers(0, 12, n),
+    }
+    return np.stack([columns[name] for name in engine.FEATURES], axis=1)
+
+
+def catalog(n: int, seed: int = 0, chunk: int = 1_000_000) -> dict:
+    """Returns the snapshot arrays of a synthetic catalog of n songs.
+
+    Rows are generated a chunk at a time so large catalogs never hold their
+    float64 features at once.
+    """
+    features = np.empty((n, len(engine.FEATURES)), dtype=np.float32)
+    for i, start in enumerate(range(0, n, chunk)):
+        raw = synthetic(min(chunk, n - start), seed + i)
+        features[start : start + len(raw)] = engine.normalize(raw)
+
+    rng = np.random.default_rng(seed)
+    return {
+        "ids": np.char.zfill(np.arange(n).astype(np.bytes_), 22),
+        "features": features,
+        "year": rng.integers(1950, 2024, n).astype(np.int16),
+        "explicit": rng.random(n) < 0.1,
+        "key": rng.integers(0, 12, n).astype(np.int8),
+        "mode": rng.integers(0, 2, n).astype(np.int8),
+        "time_signature": rng.choice([3, 4, 5], n, p=[0.1, 0.85, 0.05]).astype(np.int8),
+    }
+
+
+def build(arrays: dict, mode: str) -> index.SongIndex:
+    songs = index.SongIndex(**arrays)
+    if mode == "ivf":
+        songs.build_ann()
+    elif mode in engine.CODES:
+        songs.quantize(mode)
+    return songs
+
+
+def recall(expected: list, found: list) -> float:
+    hits = sum(len(np.intersect1d(a, b)) for a, b in zip(expected, found))
+    return hits / sum(len(a) for a in expected)
+
+
+def run(songs: index.SongIndex, kind: str, seeds: np.ndarray, k: int, batch: int):
+    """Runs one kind of query per seed row, returning results and latencies.
+
+    Batched queries are timed per search_many call of batch seeds.
+    """
+    features = songs.features
+    results, latencies = [], []
+    if kind == "batched":
+        for start in range(0, len(seeds), batch):
+            rows = seeds[start : start + batch]
+            began = time.perf_counter()
+            found = songs.search_many(features[rows], k, [[row] for row in rows])
+            latencies.append(time.perf_counter() - began)
+            results += [found_rows for found_rows, _ in found]
+        return results, latencies
+
+    for i, row in enumerate(seeds):
+        if kind == "multi":
+            rows = seeds[[i, (i + 1) % len(seeds), (i + 2) % len(seeds)]]
+            arguments = (features[rows], k, rows)
+        elif kind == "filtered":
+            filters = {"explicit": False, "year": (1990, 2010)}
+            arguments = (features[row], k, [row], "centroid", filters)
+        else:
+            arguments = (features[row], k, [row])
+        began = time.perf_counter()
+        found, _ = songs.search(*arguments)
+        latencies.append(time.perf_counter() - began)
+        results.append(found)
+    return results, latencies
+
+
+def suite(
+    sizes: list,
+    modes: list,
+    kinds: list,
+    queries: int = 200,
+    k: int = 10,
+    batch: int = 32,
+    seed: int = 0,
+) -> dict:
+    """Benchmarks every query kind on every index mode and catalog size.
+
+    Recall is measured against the exact index on the same queries.
+    """
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "queries": queries,
+        "k": k,
+        "batch": batch,
+        "seed": seed,
+        "results": [],
+    }
+    for size in sizes:
+        arrays = catalog(size, seed)
+        seeds = np.random.default_rng(seed).choice(size, queries, replace=False)
+        exact = build(arrays, "exact")
+        expected = {kind: run(exact, kind, seeds, k, batch)[0] for kind in kinds}
+
+        for mode in modes:
+            began = time.perf_counter()
+            songs = exact if mode == "exact" else build(arrays, mode)
+            build_seconds = time.perf_counter() - began
+            for kind in kinds:
+                results, latencies = run(songs, kind, seeds, k, batch)
+                latencies = np.array(latencies) * 1000
+                report["results"].append(
+                    {
+                        "rows": size,
+                        "mode": mode,
+                        "query": kind,
+                        "build_s": round(build_seconds, 3),
+                        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+                        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+                        "qps": round(queries / latencies.sum() * 1000, 1),
+                        "recall": round(recall(expected[kind], results), 4),
+                    }
+                )
+                print(json.dumps(report["results"][-1]), file=sys.stderr)
+    return report
+
+
+def quantization(rows: int, queries: int = 100, k: int = 10, rerank: int = 16):
+    """Compares the scanned bytes, recall and latency of each precision."""
+    features = engine.normalize(synthetic(rows))
+    ids = np.arange(rows).astype(np.bytes_)
+    seeds = np.random.default_rng(1).choice(rows, queries, replace=False)
+
+    exact = index.SongIndex(ids, features)
+    expected = [exact.search(features[row], k, [row])[0] for row in seeds]
+
+    print(f"{rows} rows, {queries} queries, top {k}")
+    print(f"{'precision':<10} {'rerank':>6} {'scanned MB':>10} {'recall':>7} {'ms':>7}")
+    configurations = [("float32", 0)] + [
+        (precision, factor)
+        for precision in engine.CODES
+        for factor in [0, rerank, rerank * 4]
+    ]
+    for precision, factor in configurations:
+        songs = index.SongIndex(ids, features)
+        if precision != "float32":
+            songs.quantize(precision, factor)
+        scanned = songs.codes if songs.codes is not None else songs.features
+
+        start = time.perf_counter()
+        found = [songs.search(features[row], k, [row])[0] for row in seeds]
+        elapsed = (time.perf_counter() - start) / queries * 1000
+
+        print(
+            f"{precision:<10} {factor:>6} {scanned.nbytes / 2**20:>10.1f} "
+            f"{recall(expected, found):>7.4f} {elapsed:>7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recommender benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_suite = commands.add_parser("suite", help="latency and recall as JSON")
+    run_suite.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    run_suite.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    run_suite.add_argument("--kinds", nargs="+", choices=QUERIES, default=QUERIES)
+    run_suite.add_argument("--queries", type=int, default=200)
+    run_suite.add_argument("--k", type=int, default=10)
+    run_suite.add_argument("--batch", type=int, default=32)
+    run_suite.add_argument("--seed", type=int, default=0)
+    run_suite.add_argument("--output", help="JSON file, printed when not set")
+
+    compare = commands.add_parser("quantization", help="precision trade-off table")
+    compare.add_argument("--rows", type=int, default=1_000_000)
+    compare.add_argument("--queries", type=int, default=100)
+    compare.add_argument("--k", type=int, default=10)
+    compare.add_argument("--rerank", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.command == "quantization":
+        quantization(args.rows, args.queries, args.k, args.rerank)
+    else:
+        report = suite(
+            args.sizes,
+            args.modes,
+            args.kinds,
+            args.queries,
+            args.k,
+            args.batch,
+            args.seed,
+        )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
@@ -0,0 +1,160 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from app.utils.config import settings
+
+
+class RecommendationCache:
+    """LRU cache of ranked song ids with a time to live.
+
+    Entries are grouped under a tag, the endpoint and seed they were computed
+    for, so writes that change a seed (starring a song, editing a playlist)
+    can drop every entry of that seed. Concurrent misses of the same key wait
+    for the first one instead of computing the ranking again.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        # key -> (expiry, tag, ranked ids), least recently used first
+        self.entries: OrderedDict[tuple, tuple[float, tuple, list]] = OrderedDict()
+        self.tags: dict[tuple, set] = {}
+        self.pending: dict[tuple, Future] = {}
+        # Pending keys invalidated while computing, their result is not stored
+        self.stale: set[tuple] = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, tag: tuple, params: tuple, compute):
+        if self.size <= 0:
+            return compute()
+
+        key = tag + params
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry:
+                self.remove(key)
+                self.evictions += 1
+
+            self.misses += 1
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = self.pending[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self.lock:
+                del self.pending[key]
+                self.stale.discard(key)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.pending[key]
+            if key in self.stale:
+                self.stale.remove(key)
+            else:
+                self.store(tag, key, value)
+        future.set_result(value)
+        return value
+
+    def store(self, tag: tuple, key: tuple, value: list):
+        self.entries[key] = (time.monotonic() + self.ttl, tag, value)
+        self.entries.move_to_end(key)
+        self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.size:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key: tuple):
+        _, tag, _ = self.entries.pop(key)
+        self.tags[tag].discard(key)
+        if not self.tags[tag]:
+            del self.tags[tag]
+
+    def invalidate(self, *tag):
+        """Drops every entry computed for the given endpoint and seed."""
+        with self.lock:
+            for key in self.tags.pop(tag, ()):
+                del self.entries[key]
+            self.stale.update(key for key in self.pending if key[: len(tag)] == tag)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+            self.stale.update(self.pending)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "capacity": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class CursorStore:
+    """Ranked id lists paged through by opaque cursors, with a time to live.
+
+    A cursor names a stored list and the offset of the next page in it, so
+    later pages are sliced from the list instead of ranking again. Lists are
+    dropped oldest first and when they expire, after which
+    their cursors are invalid.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        # key -> (expiry, tag, ranked ids)
+        self.entries: OrderedDict[str, tuple[float, tuple, list]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, tag: tuple, ids: list) -> str | None:
+        """Stores ids ranked for tag, returning the key their cursors start with."""
+        if self.size <= 0:
+            return None
+
+        key = secrets.token_urlsafe(12)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, tag, ids)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return key
+
+    def read(self, cursor: str, tag: tuple) -> tuple[str, list, int] | None:
+        """Returns the key, ids and offset of a cursor made for tag, or None."""
+        key, _, offset = cursor.rpartition(".")
+        if not offset.isdigit():
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] != tag:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+        return key, entry[2], int(offset)
+
+
+recommendations = RecommendationCache(
+    settings.recommend_cache_size, settings.recommend_cache_ttl
+)
+cursors = CursorStore(settings.recommend_cursor_size, settings.recommend_cursor_ttl)
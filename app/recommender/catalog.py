@@ -0,0 +1,252 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from app.recommender import cache, engine, index, neighbours, snapshot
+from app.utils.config import settings
+
+# The indexes served by the recommend endpoints
+song_index: index.SongIndex | None = None
+album_index: index.SongIndex | None = None
+# Serializes changes to song_index, searches never take it
+lock = threading.Lock()
+merging = False
+reloading = False
+# time.time() of the last load or reload that swapped the indexes in
+loaded_at: float | None = None
+# Steps of a reload, stage is the index of the running one
+STAGES = ["snapshots", "songs", "albums", "user catalog", "done"]
+stage = 0
+# Error of the last reload, None when it succeeded
+failure: str | None = None
+# Exact scans are split over these threads, numpy releases the GIL while scoring
+scorer = (
+    ThreadPoolExecutor(settings.recommend_shards, thread_name_prefix="recommend")
+    if settings.recommend_shards > 1
+    else None
+)
+
+
+def has_features(song) -> bool:
+    return all(getattr(song, name) is not None for name in engine.FEATURES)
+
+
+def build_index(arrays: dict) -> index.SongIndex:
+    songs = index.SongIndex(**arrays)
+    songs.pool = scorer
+    songs.shards = settings.recommend_shards
+    if settings.recommend_index == "ivf":
+        songs.build_ann(settings.ivf_lists, settings.ivf_nprobe)
+    return songs
+
+
+def load(arrays: dict, table=None):
+    """Serves the songs in arrays, with their neighbour table when given."""
+    global song_index, loaded_at
+    songs = build_index(arrays)
+    songs.neighbours = table
+    with lock:
+        song_index = songs
+        loaded_at = time.time()
+    cache.recommendations.clear()
+
+
+def load_albums(arrays: dict):
+    global album_index
+    albums = build_index(arrays)
+    with lock:
+        album_index = albums
+    cache.recommendations.clear()
+
+
+def reload(files: list, directory: str, mmap: bool, read_user_catalog):
+    """Builds new song and album indexes from the CSV files and swaps them in.
+
+    The CSVs are hashed once. Missing snapshots are built from one parse in a
+    separate, freshly spawned process, so parsing neither holds the GIL nor
+    grows this process. With RECOMMEND_PRECISION set the songs are scanned
+    from a codes snapshot. Requests that already read the old indexes finish
+    on them.
+    """
+    global stage
+    stage = STAGES.index("snapshots")
+    source = snapshot.checksum(files)
+    missing = [
+        kind
+        for kind in snapshot.KINDS
+        if snapshot.read_manifest(snapshot.path(directory, source, kind)) is None
+    ]
+    if missing:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            pool.submit(snapshot.build, files, directory, missing, source).result()
+
+    stage = STAGES.index("songs")
+    precision = settings.recommend_precision
+    # Quantized scans only read the float32 features of re-ranked rows
+    songs = build_index(
+        snapshot.load_or_build(
+            files, directory, mmap or precision != "float32", source=source
+        )
+    )
+    if precision != "float32":
+        codes = snapshot.load_or_build_codes(files, directory, precision, mmap, source)
+        songs.use_codes(
+            codes["codes"], codes["scale"], codes["offset"], settings.recommend_rerank
+        )
+    songs.neighbours = neighbours.load(files, directory, mmap, source)
+    stage = STAGES.index("albums")
+    albums = build_index(
+        snapshot.load_or_build(files, directory, mmap, "albums", source)
+    )
+    swap(songs, albums, read_user_catalog)
+
+
+def reload_database(read_catalog, read_user_catalog):
+    """Builds new song and album indexes from the database and swaps them in.
+
+    read_catalog returns the arrays of the "songs" or "albums" table. User
+    songs added while they are read are appended before the swap, songs
+    deleted meanwhile are only dropped by the next reload.
+    """
+    global stage
+    stage = STAGES.index("songs")
+    songs = build_index(read_catalog("songs"))
+    stage = STAGES.index("albums")
+    albums = build_index(read_catalog("albums"))
+    swap(songs, albums, read_user_catalog)
+
+
+def swap(songs: index.SongIndex, albums: index.SongIndex, read_user_catalog):
+    """Serves the given indexes, adding the user songs and albums to them first.
+
+    read_user_catalog returns the user songs and albums, it is called while
+    changes are held off so none made during the rebuild is lost.
+    """
+    global song_index, album_index, loaded_at, stage
+    stage = STAGES.index("user catalog")
+    with lock:
+        user_songs, user_albums = read_user_catalog()
+        user_songs = [song for song in user_songs if has_features(song)]
+        user_albums = [album for album in user_albums if has_features(album)]
+        if user_songs:
+            songs.append(snapshot.from_models(user_songs))
+        if user_albums:
+            albums.append(snapshot.from_models(user_albums))
+        song_index, album_index = songs, albums
+        loaded_at = time.time()
+    stage = STAGES.index("done")
+    cache.recommendations.clear()
+
+
+def start_reload(load, *args) -> bool:
+    """Runs load with args in a thread, unless a reload is running already."""
+    global reloading
+    with lock:
+        if reloading:
+            return False
+        reloading = True
+
+    def run():
+        global reloading, failure
+        try:
+            load(*args)
+            failure = None
+        except Exception as e:
+            failure = repr(e)
+            raise
+        finally:
+            reloading = False
+
+    threading.Thread(target=run, name="catalog-reload", daemon=True).start()
+    return True
+
+
+def add_albums(albums: list):
+    """Makes albums with audio features recommendable.
+
+    Albums change rarely, so they stay in the delta until the next load.
+    """
+    albums = [album for album in albums if has_features(album)]
+    if album_index is None or not albums:
+        return
+
+    with lock:
+        album_index.append(snapshot.from_models(albums))
+    cache.recommendations.clear()
+
+
+def remove_albums(ids: list[str]):
+    if album_index is None:
+        return
+
+    with lock:
+        album_index.remove(ids)
+    cache.recommendations.clear()
+
+
+def add_songs(songs: list):
+    """Makes songs with audio features recommendable, merging when needed."""
+    songs = [song for song in songs if has_features(song)]
+    if song_index is None or not songs:
+        return
+
+    with lock:
+        song_index.append(snapshot.from_models(songs))
+        delta, _ = song_index.changes
+        merge = delta is not None and len(delta.ids) >= settings.delta_merge_size
+    cache.recommendations.clear()
+
+    if merge:
+        start_merge()
+
+
+def remove_songs(ids: list[str]):
+    if song_index is None:
+        return
+
+    with lock:
+        song_index.remove(ids)
+    cache.recommendations.clear()
+
+
+def start_merge():
+    global merging
+    with lock:
+        if merging:
+            return
+        merging = True
+    threading.Thread(target=merge, name="catalog-merge", daemon=True).start()
+
+
+def merge():
+    """Builds an index holding the delta and swaps it in, keeping newer changes.
+
+    Songs added or removed while the new index is built are applied to it
+    before the swap, so no change is lost. The neighbour table is translated
+    to the merged rows, the songs merged in are scored exactly until it is
+    rebuilt.
+    """
+    global song_index, merging, loaded_at
+    try:
+        old = song_index
+        delta, removed = changes = old.changes
+        merged = build_index(old.merged(changes))
+        merged.neighbours = old.merged_neighbours(changes)
+
+        with lock:
+            if song_index is not old:
+                return
+            new_delta, new_removed = old.changes
+            if new_delta is not None:
+                added = len(delta.ids) if delta is not None else 0
+                merged.append(new_delta.take(np.arange(added, len(new_delta.ids))))
+            merged.remove(old.get_ids(np.setdiff1d(new_removed, removed)))
+            song_index = merged
+            loaded_at = time.time()
+        cache.recommendations.clear()
+    finally:
+        merging = False
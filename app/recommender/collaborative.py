@@ -0,0 +1,136 @@
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+
+from app.recommender import engine
+
+
+class CoOccurrence:
+    """Item-item similarity of songs from the collections they appear in.
+
+    Every star list and playlist is a collection. Two songs are as similar
+    as the cosine of their collection vectors: the number of collections
+    holding both, over the square root of the product of their counts.
+    """
+
+    def __init__(self, ids: np.ndarray, matrix: sparse.csr_matrix):
+        # Sorted song ids, the row and column of every song in matrix
+        self.ids = ids
+        self.matrix = matrix
+
+    @classmethod
+    def build(cls, collections: np.ndarray, songs: np.ndarray):
+        """Builds the similarities of (collection, song id) pairs."""
+        ids, columns = np.unique(songs.astype(str), return_inverse=True)
+        _, rows = np.unique(collections, return_inverse=True)
+        incidence = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, columns)),
+            shape=(rows.max() + 1 if len(rows) else 0, len(ids)),
+        )
+        # A song twice in one collection counts once
+        incidence.data[:] = 1
+
+        counts = (incidence.T @ incidence).tocsr()
+        norms = sparse.diags(1 / np.sqrt(counts.diagonal().clip(1)))
+        matrix = (norms @ counts @ norms).tocsr()
+        matrix.setdiag(0)
+        matrix.eliminate_zeros()
+        return cls(ids, matrix.astype(np.float32))
+
+    def row(self, id: str) -> int | None:
+        position = np.searchsorted(self.ids, id)
+        if position < len(self.ids) and self.ids[position] == id:
+            return int(position)
+        return None
+
+    def similar(self, id: str, k: int, exclude=()) -> tuple[list[str], np.ndarray]:
+        """Returns the ids and similarities of the k songs most similar to id."""
+        row = self.row(id)
+        if row is None:
+            return [], np.empty(0, dtype=np.float32)
+
+        start, stop = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        columns = self.matrix.indices[start:stop]
+        scores = self.matrix.data[start:stop]
+        order = np.argsort(columns)
+        columns, scores = columns[order], scores[order]
+
+        skip = np.flatnonzero(np.isin(self.ids[columns], list(exclude)))
+        positions, scores = engine.top_k(scores, k, skip)
+        return self.ids[columns[positions]].tolist(), scores
+
+
+def blend(audio: dict, collaborative: dict, weight: float, k: int) -> list[str]:
+    """Returns the k best ids of the weighted sum of both kinds of scores.
+
+    Audio similarities of catalog songs are all close to 1, so they are
+    rescaled to [0, 1] over the candidates before they are weighted. Ids
+    missing from one of the dicts score 0 in it.
+    """
+    ids = sorted(audio.keys() | collaborative.keys())
+    audio_scores = np.array([audio.get(id, -np.inf) for id in ids])
+    known = np.isfinite(audio_scores)
+    if known.any():
+        low, high = audio_scores[known].min(), audio_scores[known].max()
+        audio_scores = np.where(known, (audio_scores - low) / ((high - low) or 1), 0)
+    else:
+        audio_scores = np.zeros(len(ids))
+
+    scores = (1 - weight) * audio_scores + weight * np.array(
+        [collaborative.get(id, 0) for id in ids]
+    )
+    positions, _ = engine.top_k(scores, k)
+    return [ids[position] for position in positions]
+
+
+def pairs(chunks) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the collections and song ids of chunks of (collection, id) rows."""
+    collections, songs = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=str)]
+    for rows in chunks:
+        if rows:
+            collection_column, song_column = zip(*rows)
+            collections.append(np.array(collection_column, dtype=np.int64))
+            songs.append(np.array(song_column, dtype=str))
+    return np.concatenate(collections), np.concatenate(songs)
+
+
+# The similarities served by the recommend endpoints, None until first built
+similarities: CoOccurrence | None = None
+# Number of builds, part of cached blended rankings so a rebuild outdates them
+version = 0
+# Set by every star and playlist change, cleared when a rebuild starts
+stale = True
+
+
+def mark_changed():
+    global stale
+    stale = True
+
+
+def rebuild(read_pairs):
+    """Replaces the similarities with ones built from the pairs read_pairs returns."""
+    global similarities, stale, version
+    stale = False
+    similarities = CoOccurrence.build(*read_pairs())
+    version += 1
+
+
+def schedule(read_pairs, interval: float):
+    """Rebuilds the similarities in a thread, every interval seconds they changed.
+
+    Changes made while a rebuild reads the tables mark it stale again, so they
+    are picked up by the next one.
+    """
+
+    def run():
+        while True:
+            if stale:
+                try:
+                    rebuild(read_pairs)
+                except Exception as e:
+                    print(f"ERROR:    Could not build collaborative index: {e!r}")
+            time.sleep(interval)
+
+    threading.Thread(target=run, name="collaborative", daemon=True).start()
@@ -0,0 +1,199 @@
+import numpy as np
+
+# Audio features used for similarity, in matrix column order
+FEATURES = [
+    "danceability",
+    "speechiness",
+    "acousticness",
+    "instrumentalness",
+    "liveness",
+    "valence",
+    "tempo",
+    "loudness",
+    "mode",
+    "key",
+]
+
+
+def normalize(features) -> np.ndarray:
+    """Returns the rows of features as unit length float32 vectors."""
+    matrix = np.nan_to_num(np.asarray(features, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+def combine(queries: np.ndarray, aggregate: str = "centroid") -> np.ndarray:
+    """Reduces unit length queries to one vector for centroid or mean scoring.
+
+    Scoring rows against the mean of the queries gives the mean of their
+    similarities, so neither needs a similarity per query.
+    """
+    mean = queries.mean(axis=0)
+    return normalize([mean])[0] if aggregate == "centroid" else mean
+
+
+def score(
+    features: np.ndarray,
+    queries: np.ndarray,
+    aggregate: str = "centroid",
+    chunk: int = 65536,
+    scale: np.ndarray | None = None,
+    offset: np.ndarray | None = None,
+) -> np.ndarray:
+    """Returns the aggregated similarity of every row to the unit length queries.
+
+    Max and min scoring work through the rows in chunks, so only a chunk by
+    queries block of similarities exists at any time. Features that are not
+    float32 are quantized codes, copied a chunk at a time into one reused
+    float32 buffer and mapped back to feature values by the per column scale
+    and offset when they are given.
+    """
+    queries = np.atleast_2d(queries)
+    if aggregate not in ["max", "min"] or len(queries) == 1:
+        queries = combine(queries, aggregate)[np.newaxis]
+    shift = queries @ offset if offset is not None else 0
+    if scale is not None:
+        queries = queries * scale
+    if features.dtype == np.float32 and len(queries) == 1:
+        return features @ queries[0]
+
+    buffer = None
+    if features.dtype != np.float32:
+        buffer = np.empty((min(chunk, len(features)), features.shape[1]), np.float32)
+    scores = np.empty(len(features), dtype=np.float32)
+    for start in range(0, len(features), chunk):
+        rows = features[start : start + chunk]
+        if buffer is not None:
+            np.copyto(buffer[: len(rows)], rows, casting="unsafe")
+            rows = buffer[: len(rows)]
+        block = rows @ queries.T
+        block += shift
+        reduce = block.min if aggregate == "min" else block.max
+        reduce(axis=1, out=scores[start : start + chunk])
+    return scores
+
+
+# Integer type of quantized codes and the standard deviations around the
+# mean of each column their range spans, wider ranges clip fewer values
+CODES = {"int16": (np.int16, 6), "int8": (np.int8, 3)}
+
+
+def quantize(features: np.ndarray, precision: str):
+    """Returns features as int16 or int8 codes, with their scale and offset.
+
+    Each column is standardized before it is rounded, so the codes spend their
+    values on the spread of that column around its mean rather than on its
+    outliers. A row is approximately offset + codes * scale.
+    """
+    dtype, sigmas = CODES[precision]
+    info = np.iinfo(dtype)
+    offset = features.mean(axis=0, dtype=np.float64)
+    scale = 2 * sigmas * features.std(axis=0, dtype=np.float64) / (info.max - info.min)
+    scale[scale == 0] = 1
+    codes = np.rint((features - offset) / scale).clip(info.min, info.max)
+    return codes.astype(dtype), scale.astype(np.float32), offset.astype(np.float32)
+
+
+def top_k(scores: np.ndarray, k: int, exclude=()):
+    """Returns the indices and scores of the k best scores, best first.
+
+    Rows in exclude are never returned. Ties are broken by the lower index so
+    the result does not depend on how the selection was partitioned.
+    """
+    exclude = np.unique(np.asarray(exclude, dtype=np.intp))
+    width = min(k + len(exclude), len(scores))
+    if k <= 0 or width <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=scores.dtype)
+
+    if width < len(scores):
+        partition = np.argpartition(scores, len(scores) - width)[-width:]
+        threshold = scores[partition].min()
+        candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(len(scores))
+
+    candidates = candidates[~np.isin(candidates, exclude)]
+    candidates = candidates[scores[candidates] > -np.inf]
+    order = np.lexsort((candidates, -scores[candidates]))[:k]
+    indices = candidates[order]
+    return indices, scores[indices]
+
+
+def merge(parts: list, k: int):
+    """Merges (rows, scores) top-k results of disjoint rows into one top-k.
+
+    Ties are broken by the lower row, like top_k does within one part.
+    """
+    rows = np.concatenate([rows for rows, _ in parts])
+    scores = np.concatenate([scores for _, scores in parts])
+    order = np.lexsort((rows, -scores))[:k]
+    return rows[order], scores[order]
+
+
+def batch_top_k(
+    features: np.ndarray,
+    queries: np.ndarray,
+    k: int,
+    excludes: list,
+    chunk: int = 262144,
+) -> list:
+    """Returns top_k of every query, scoring all of them with one product per chunk.
+
+    Each chunk of rows is multiplied with the whole query matrix and keeps its
+    own top k per query, which are merged at the end.
+    """
+    excludes = [np.asarray(exclude, dtype=np.intp) for exclude in excludes]
+    parts = [[] for _ in queries]
+    for start in range(0, len(features), chunk):
+        block = queries @ features[start : start + chunk].T
+        end = start + block.shape[1]
+        for i, exclude in enumerate(excludes):
+            local = exclude[(exclude >= start) & (exclude < end)] - start
+            rows, scores = top_k(block[i], k, local)
+            parts[i].append((rows + start, scores))
+    return [merge(part, k) if part else top_k(np.empty(0), k) for part in parts]
+
+
+def sharded_top_k(
+    features: np.ndarray,
+    queries: np.ndarray,
+    k: int,
+    exclude=(),
+    aggregate: str = "centroid",
+    mask: np.ndarray | None = None,
+    pool=None,
+    shards: int = 1,
+    scale: np.ndarray | None = None,
+    offset: np.ndarray | None = None,
+):
+    """Returns top_k of the aggregated scores of queries, masked rows left out.
+
+    With a pool, the rows are split into contiguous shards that are scored
+    and reduced to a local top k concurrently, then merged. Every row gets
+    the same score either way and merge breaks ties like top_k, so the
+    result does not depend on the number of shards.
+    """
+    exclude = np.asarray(exclude, dtype=np.intp)
+
+    def shard(start: int, stop: int):
+        scores = score(
+            features[start:stop], queries, aggregate, scale=scale, offset=offset
+        )
+        local = exclude[(exclude >= start) & (exclude < stop)] - start
+        if mask is None:
+            rows, scores = top_k(scores, k, local)
+            return rows + start, scores
+
+        # Masking with -inf instead would leave many equal scores, on which
+        # argpartition gets several times slower
+        kept = np.flatnonzero(mask[start:stop])
+        skip = np.flatnonzero(np.isin(kept, local))
+        positions, scores = top_k(scores[kept], k, skip)
+        return kept[positions] + start, scores
+
+    if pool is None or shards <= 1 or len(features) < shards:
+        return shard(0, len(features))
+
+    bounds = np.linspace(0, len(features), shards + 1).astype(np.intp)
+    return merge(list(pool.map(shard, bounds[:-1], bounds[1:])), k)
@@ -0,0 +1,374 @@
+import numpy as np
+
+from app.recommender import ann, engine
+
+# Columns filtered by equality, each value gets a precomputed bitset
+MASKED = ["explicit", "key", "mode", "time_signature"]
+
+
+class SongIndex:
+    """Catalog song ids and their normalized features, without any metadata.
+
+    Ids are kept as one fixed-width bytes array together with the order that
+    sorts it, so looking up the row of an id is a binary search instead of a
+    dictionary holding a Python string per song.
+
+    Songs added after the index was built go to a small delta index that is
+    scanned exactly next to the main one, and removed songs are hidden by
+    their row until both are merged into a new index. Delta rows are numbered
+    after the main rows.
+    """
+
+    def __init__(self, ids: np.ndarray, features: np.ndarray, order=None, **columns):
+        self.ids = ids
+        self.features = features
+        self.order = np.argsort(ids, kind="stable") if order is None else order
+        self.columns = columns
+        # (column, value) -> rows holding value, packed 8 rows per byte
+        self.masks = {
+            (name, value.item()): np.packbits(columns[name] == value)
+            for name in MASKED
+            if name in columns
+            for value in np.unique(columns[name])
+        }
+        self.ann: ann.IVFIndex | None = None
+        self.nprobe = 0
+        # Thread pool exact scans are split over, in this many shards
+        self.pool = None
+        self.shards = 1
+        # Quantized copy of features scanned instead of them, see quantize
+        self.codes: np.ndarray | None = None
+        self.scale: np.ndarray | None = None
+        self.offset: np.ndarray | None = None
+        self.rerank = 0
+        # Per column mean and standard deviation of the features, see statistics
+        self.stats: tuple[np.ndarray, np.ndarray] | None = None
+        # Precomputed nearest main rows of the first main rows, best first.
+        # Rows merged in later have no entry and are scored like the delta,
+        # -1 pads entries of rows removed by a merge
+        self.neighbours: np.ndarray | None = None
+        # (delta index, removed rows), always replaced as a whole
+        self.changes: tuple[SongIndex | None, np.ndarray] = (
+            None,
+            np.empty(0, dtype=np.intp),
+        )
+
+    def __len__(self):
+        delta, removed = self.changes
+        return (
+            len(self.ids) + (len(delta.ids) if delta is not None else 0) - len(removed)
+        )
+
+    def find_rows(self, ids: list[str]) -> np.ndarray:
+        """Returns the main rows of the given ids, skipping unknown ids."""
+        keys = [id.encode() for id in ids]
+        keys = np.array(
+            [key for key in keys if len(key) <= self.ids.itemsize], dtype=self.ids.dtype
+        )
+        if not len(self.ids) or not len(keys):
+            return np.empty(0, dtype=np.intp)
+
+        positions = np.searchsorted(self.ids, keys, sorter=self.order)
+        rows = self.order[np.minimum(positions, len(self.ids) - 1)].astype(np.intp)
+        return rows[self.ids[rows] == keys]
+
+    def get_rows(self, ids: list[str]) -> np.ndarray:
+        """Returns the rows of the given ids, skipping ids not in the index."""
+        delta, removed = self.changes
+        rows = self.find_rows(ids)
+        if delta is not None:
+            rows = np.concatenate([rows, delta.find_rows(ids) + len(self.ids)])
+        return rows[~np.isin(rows, removed)]
+
+    def get_ids(self, rows: np.ndarray) -> list[str]:
+        delta, _ = self.changes
+        ids = []
+        for row in rows:
+            if row < len(self.ids):
+                ids.append(self.ids[row].decode())
+            else:
+                ids.append(delta.ids[row - len(self.ids)].decode())
+        return ids
+
+    def take(self, rows: np.ndarray) -> dict:
+        """Returns the arrays of the given main rows, as stored in a snapshot."""
+        arrays = {"ids": self.ids[rows], "features": self.features[rows]}
+        for name, column in self.columns.items():
+            arrays[name] = column[rows]
+        return arrays
+
+    def append(self, arrays: dict):
+        """Adds the songs in arrays that are not in the index yet to the delta."""
+        delta, removed = self.changes
+        ids = [id.decode() for id in arrays["ids"]]
+        known = set(self.get_ids(self.get_rows(ids)))
+        new = np.array([id not in known for id in ids], dtype=bool)
+        if not new.any():
+            return
+
+        arrays = {name: array[new] for name, array in arrays.items() if name != "order"}
+        if delta is not None:
+            old = delta.take(np.arange(len(delta.ids)))
+            arrays = {name: np.concatenate([old[name], arrays[name]]) for name in old}
+        self.changes = (SongIndex(**arrays), removed)
+
+    def remove(self, ids: list[str]):
+        delta, removed = self.changes
+        self.changes = (delta, np.union1d(removed, self.get_rows(ids)))
+
+    def merged(self, changes: tuple | None = None) -> dict:
+        """Returns the arrays of the main and delta rows that are not removed.
+
+        Uses the given changes instead of the current ones when set.
+        """
+        delta, removed = changes or self.changes
+        main = self.take(np.setdiff1d(np.arange(len(self.ids)), removed))
+        if delta is None:
+            return main
+
+        added = delta.take(
+            np.setdiff1d(np.arange(len(delta.ids)), removed - len(self.ids))
+        )
+        return {name: np.concatenate([main[name], added[name]]) for name in main}
+
+    def merged_neighbours(self, changes: tuple | None = None) -> np.ndarray | None:
+        """Returns the neighbour table translated to the rows of merged.
+
+        Entries of removed rows become -1, the merged delta rows get none.
+        """
+        if self.neighbours is None:
+            return None
+        _, removed = changes or self.changes
+        kept = np.setdiff1d(np.arange(len(self.ids)), removed)
+        # One extra slot keeps the -1 entries of earlier merges at -1
+        rows = np.full(len(self.ids) + 1, -1, dtype=self.neighbours.dtype)
+        rows[kept] = np.arange(len(kept))
+        return rows[self.neighbours[kept[kept < len(self.neighbours)]]]
+
+    def mask(self, filters: dict | None) -> np.ndarray | None:
+        """Returns which main rows pass the filters, or None without filters.
+
+        Filters map a masked column to its required value, and "year" to an
+        inclusive (minimum, maximum) range where either bound may be None.
+        """
+        if not filters:
+            return None
+
+        packed = np.full((len(self.ids) + 7) // 8, 0xFF, dtype=np.uint8)
+        for name, value in filters.items():
+            if name in MASKED:
+                bits = self.masks.get((name, value))
+                if bits is None:
+                    return np.zeros(len(self.ids), dtype=bool)
+                packed &= bits
+        mask = np.unpackbits(packed, count=len(self.ids)).view(bool)
+
+        minimum, maximum = filters.get("year", (None, None))
+        if minimum is not None or maximum is not None:
+            years = self.columns.get("year")
+            if years is None:
+                return np.zeros(len(self.ids), dtype=bool)
+            if minimum is not None:
+                mask &= years >= minimum
+            if maximum is not None:
+                mask &= years <= maximum
+        return mask
+
+    def get_features(self, rows: np.ndarray) -> np.ndarray:
+        """Returns the features of the given main and delta rows."""
+        delta, _ = self.changes
+        rows = np.asarray(rows, dtype=np.intp)
+        features = np.empty((len(rows), self.features.shape[1]), dtype=np.float32)
+        main = rows < len(self.ids)
+        features[main] = self.features[rows[main]]
+        if not main.all():
+            features[~main] = delta.features[rows[~main] - len(self.ids)]
+        return features
+
+    def statistics(self) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the mean and standard deviation of each main feature column.
+
+        Computed once per index, constant columns get a deviation of 1.
+        """
+        if self.stats is None:
+            features = np.asarray(self.features)
+            std = features.std(axis=0, dtype=np.float64)
+            std[std == 0] = 1
+            self.stats = features.mean(axis=0, dtype=np.float64), std
+        return self.stats
+
+    def passes(self, rows: np.ndarray, filters: dict | None) -> np.ndarray:
+        """Returns which of the given main and delta rows pass the filters."""
+        delta, _ = self.changes
+        rows = np.asarray(rows, dtype=np.intp)
+        passed = np.ones(len(rows), dtype=bool)
+        if not filters:
+            return passed
+
+        main = rows < len(self.ids)
+        passed[main] = self.mask(filters)[rows[main]]
+        if not main.all():
+            passed[~main] = delta.mask(filters)[rows[~main] - len(self.ids)]
+        return passed
+
+    def build_ann(self, n_lists: int = 0, nprobe: int = 16):
+        """Serves searches from an IVF index instead of scanning every row."""
+        self.ann = ann.IVFIndex.build(self.features, n_lists)
+        self.nprobe = nprobe
+
+    def quantize(self, precision: str, rerank: int = 16):
+        """Scans int16 or int8 codes of the features instead of the features.
+
+        The best rerank * k rows of a scan are scored again with the float32
+        features, 0 returns the quantized scores as is.
+        """
+        codes, scale, offset = engine.quantize(np.asarray(self.features), precision)
+        self.use_codes(codes, scale, offset, rerank)
+
+    def use_codes(self, codes, scale, offset, rerank: int = 16):
+        """Scans the given codes of the main rows, see engine.quantize.
+
+        With memory mapped features only the codes and the re-ranked rows
+        need to be in memory.
+        """
+        self.codes, self.scale, self.offset = codes, scale, offset
+        self.rerank = rerank
+
+    def scan(self, queries, k, exclude, aggregate, mask):
+        """Returns the exact top k main rows, scanning the codes when quantized."""
+        if self.codes is None:
+            return engine.sharded_top_k(
+                self.features,
+                queries,
+                k,
+                exclude,
+                aggregate,
+                mask,
+                self.pool,
+                self.shards,
+            )
+
+        rows, scores = engine.sharded_top_k(
+            self.codes,
+            queries,
+            k * max(self.rerank, 1),
+            exclude,
+            aggregate,
+            mask,
+            self.pool,
+            self.shards,
+            self.scale,
+            self.offset,
+        )
+        if not self.rerank:
+            return rows, scores
+        positions, scores = engine.top_k(
+            engine.score(self.features[rows], queries, aggregate), k
+        )
+        return rows[positions], scores
+
+    def lookup(self, row: int, k: int):
+        """Returns the k songs most similar to a main row from the neighbour table.
+
+        Only the table rows, the main rows merged in after it and the delta
+        are scored. Returns None when the table cannot answer: no table, a row
+        without an entry, a k wider than the table or too many of its rows
+        removed.
+        """
+        if self.neighbours is None or row >= len(self.neighbours):
+            return None
+        if k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        if k > self.neighbours.shape[1]:
+            return None
+
+        delta, removed = self.changes
+        rows = self.neighbours[row].astype(np.intp)
+        rows = rows[(rows >= 0) & ~np.isin(rows, removed)]
+        if len(rows) < k:
+            return None
+
+        query = self.features[row]
+        parts = [(rows[:k], self.features[rows[:k]] @ query)]
+        covered = len(self.neighbours)
+        if covered < len(self.ids):
+            scores = self.features[covered:] @ query
+            tail_exclude = removed[(removed >= covered) & (removed < len(self.ids))]
+            tail_rows, scores = engine.top_k(scores, k, tail_exclude - covered)
+            parts.append((tail_rows + covered, scores))
+        if delta is not None:
+            delta_exclude = removed[removed >= len(self.ids)] - len(self.ids)
+            delta_rows, scores = engine.top_k(delta.features @ query, k, delta_exclude)
+            parts.append((delta_rows + len(self.ids), scores))
+        return engine.merge(parts, k) if len(parts) > 1 else parts[0]
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        exclude=(),
+        aggregate: str = "centroid",
+        filters: dict | None = None,
+    ):
+        """Returns the rows and scores of the k songs most similar to the queries.
+
+        Uses the approximate index when one is built, falling back to an exact
+        scan when its probed lists are too small to provide k results. Rows
+        failing the filters are dropped before ranking, so fewer than k rows
+        are only returned when fewer songs pass them.
+        """
+        queries = np.atleast_2d(queries)
+        delta, removed = self.changes
+        exclude = np.union1d(np.asarray(exclude, dtype=np.intp), removed)
+        main_exclude = exclude[exclude < len(self.ids)]
+        mask = self.mask(filters)
+
+        result = None
+        if self.ann is not None:
+            result = self.ann.search(
+                self.features, queries, k, self.nprobe, main_exclude, aggregate, mask
+            )
+        if result is None:
+            result = self.scan(queries, k, main_exclude, aggregate, mask)
+        if delta is None:
+            return result
+
+        delta_exclude = exclude[exclude >= len(self.ids)] - len(self.ids)
+        scores = engine.score(delta.features, queries, aggregate)
+        mask = delta.mask(filters)
+        if mask is not None:
+            scores[~mask] = -np.inf
+        rows, scores = engine.top_k(scores, k, delta_exclude)
+        return engine.merge([result, (rows + len(self.ids), scores)], k)
+
+    def search_many(self, queries: np.ndarray, k: int, excludes: list) -> list:
+        """Returns the search results of several single queries at once.
+
+        Exact searches score all queries with one matrix product per chunk of
+        rows, approximate and quantized ones search query by query.
+        """
+        if self.ann is not None or self.codes is not None:
+            return [self.search(q, k, exclude) for q, exclude in zip(queries, excludes)]
+
+        delta, removed = self.changes
+        excludes = [
+            np.union1d(np.asarray(exclude, dtype=np.intp), removed)
+            for exclude in excludes
+        ]
+        n = len(self.ids)
+        results = engine.batch_top_k(
+            self.features, queries, k, [exclude[exclude < n] for exclude in excludes]
+        )
+        if delta is None:
+            return results
+
+        delta_results = engine.batch_top_k(
+            delta.features,
+            queries,
+            k,
+            [exclude[exclude >= n] - n for exclude in excludes],
+        )
+        return [
+            engine.merge([result, (rows + n, scores)], k)
+            for result, (rows, scores) in zip(results, delta_results)
+        ]
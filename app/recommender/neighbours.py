@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from app.recommender import engine, snapshot
+
+# Features of the song snapshot, memory mapped once per worker process
+features: np.ndarray | None = None
+# Catalog rows scored per product, a block of 256 rows by a chunk of them
+# takes 16 MB in every worker
+CHUNK = 16384
+
+
+def open_snapshot(target: str):
+    global features
+    features = np.load(os.path.join(target, "features.npy"), mmap_mode="r")
+
+
+def block_neighbours(start: int, stop: int, k: int) -> np.ndarray:
+    """Returns the k nearest rows of the rows from start to stop, self excluded."""
+    results = engine.batch_top_k(
+        features,
+        features[start:stop],
+        k,
+        [[row] for row in range(start, stop)],
+        CHUNK,
+    )
+    return np.stack([rows for rows, _ in results]).astype(np.int32)
+
+
+def compute(target: str, k: int, workers: int = 2, block: int = 256) -> np.ndarray:
+    """Returns the k nearest neighbours of every song in a song snapshot folder.
+
+    Blocks of rows are scored against the whole catalog in a pool of worker
+    processes, which share the memory mapped features of the snapshot. 0
+    workers starts one per core.
+    """
+    open_snapshot(target)
+    n = len(features)
+    k = min(k, n - 1)
+    if k <= 0:
+        return np.empty((n, 0), dtype=np.int32)
+
+    starts = range(0, n, block)
+    with ProcessPoolExecutor(
+        workers or None, initializer=open_snapshot, initargs=(target,)
+    ) as pool:
+        parts = pool.map(
+            block_neighbours,
+            starts,
+            [min(start + block, n) for start in starts],
+            [k] * len(starts),
+        )
+        return np.concatenate(list(parts))
+
+
+def build(files: list, directory: str, k: int, workers: int = 2) -> str:
+    """Computes the neighbour table of the song snapshot of the CSV files."""
+    source = snapshot.checksum(files)
+    arrays = snapshot.load_or_build(files, directory, True, source=source)
+    neighbours = compute(snapshot.path(directory, source), k, workers)
+    return snapshot.write(
+        directory,
+        {"ids": arrays["ids"], "neighbours": neighbours},
+        source,
+        "neighbours",
+    )
+
+
+def load(
+    files: list, directory: str, mmap: bool = False, source: str | None = None
+) -> np.ndarray | None:
+    """Loads the neighbour table of the CSV files, or None when it is not built.
+
+    source is the checksum of the files when known.
+    """
+    target = snapshot.path(directory, source or snapshot.checksum(files), "neighbours")
+    if snapshot.read_manifest(target) is None:
+        return None
+    return snapshot.load(target, mmap)["neighbours"]
+
+
+if __name__ == "__main__":
+    from app.utils.config import settings
+
+    print("Computing song neighbours.. Might take a while.")
+    target = build(
+        settings.songfiles,
+        settings.snapshot_dir,
+        settings.neighbour_count,
+        settings.neighbour_workers,
+    )
+    print(f"Done! Wrote neighbours of {snapshot.read_manifest(target)['rows']} songs")
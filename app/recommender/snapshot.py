@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from app.recommender import engine
+
+# Bump whenever the set or layout of the arrays below changes
+VERSION = 4
+
+# Metadata columns kept next to the features, with their on-disk dtype
+COLUMNS = {
+    "year": np.int16,
+    "explicit": np.bool_,
+    "key": np.int8,
+    "mode": np.int8,
+    "time_signature": np.int8,
+}
+
+
+def checksum(files: list) -> str:
+    """Returns a sha256 hex digest over the contents of the given files."""
+    digest = hashlib.sha256()
+    for file in files:
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def from_frame(songs: pd.DataFrame) -> dict:
+    """Converts a catalog DataFrame into the arrays stored in a snapshot."""
+    ids = songs["id"].to_numpy().astype(np.bytes_)
+    arrays = {
+        "ids": ids,
+        "order": np.argsort(ids, kind="stable").astype(np.uint32),
+        "features": engine.normalize(songs[engine.FEATURES].to_numpy()),
+    }
+    for column, dtype in COLUMNS.items():
+        arrays[column] = songs[column].fillna(0).to_numpy().astype(dtype)
+    return arrays
+
+
+def from_rows(count: int, id_length: int, chunks) -> dict:
+    """Fills the arrays stored in a snapshot from chunks of database rows.
+
+    Rows hold the id, the FEATURES and the COLUMNS in that order. Arrays are
+    allocated for count rows up front and filled a chunk at a time, so only
+    one chunk of rows exists next to them; rows past count are ignored.
+    """
+    n = len(engine.FEATURES)
+    arrays = {
+        "ids": np.empty(count, dtype=f"S{max(id_length, 1)}"),
+        "features": np.empty((count, n), dtype=np.float32),
+    }
+    for column, dtype in COLUMNS.items():
+        arrays[column] = np.empty(count, dtype=dtype)
+
+    filled = 0
+    for rows in chunks:
+        rows = rows[: count - filled]
+        if not rows:
+            break
+        values = list(zip(*rows))
+        end = filled + len(rows)
+        arrays["ids"][filled:end] = [id.encode() for id in values[0]]
+        features = np.array(values[1 : n + 1], dtype=np.float32).T
+        arrays["features"][filled:end] = engine.normalize(features)
+        for i, column in enumerate(COLUMNS, n + 1):
+            arrays[column][filled:end] = [value or 0 for value in values[i]]
+        filled = end
+
+    arrays = {name: array[:filled] for name, array in arrays.items()}
+    arrays["order"] = np.argsort(arrays["ids"], kind="stable").astype(np.uint32)
+    return arrays
+
+
+def most_frequent(songs: pd.DataFrame, column: str) -> pd.Series:
+    """Returns the most frequent value of column per album, the lowest on ties."""
+    counts = songs.groupby(["album_id", column]).size().reset_index(name="count")
+    counts = counts.sort_values(["count", column], ascending=[False, True])
+    return counts.drop_duplicates("album_id").set_index("album_id")[column]
+
+
+def albums_from_frame(songs: pd.DataFrame) -> dict:
+    """Aggregates a catalog DataFrame into the arrays of an album snapshot.
+
+    Albums get the same values script.py stores in the albums table: the mean
+    of the audio features, and the most frequent key, mode and time signature.
+    """
+    grouped = songs.groupby("album_id")
+    albums = grouped[engine.FEATURES].mean()
+    albums["year"] = grouped["year"].max()
+    albums["explicit"] = (
+        songs["explicit"].fillna(False).groupby(songs["album_id"]).any()
+    )
+    for column in ["key", "mode", "time_signature"]:
+        albums[column] = most_frequent(songs, column)
+    return from_frame(albums.rename_axis("id").reset_index())
+
+
+# Builds the arrays of each kind of snapshot from the catalog DataFrame
+KINDS = {"songs": from_frame, "albums": albums_from_frame}
+
+
+def from_models(songs: list) -> dict:
+    """Converts Song or Album models into the arrays stored in a snapshot."""
+    ids = np.array([song.id for song in songs], dtype=np.bytes_)
+    features = [[getattr(song, name) for name in engine.FEATURES] for song in songs]
+    arrays = {
+        "ids": ids,
+        "order": np.argsort(ids, kind="stable").astype(np.uint32),
+        "features": engine.normalize(np.reshape(features, (-1, len(engine.FEATURES)))),
+    }
+    for column, dtype in COLUMNS.items():
+        values = [getattr(song, column) or 0 for song in songs]
+        arrays[column] = np.array(values, dtype=dtype)
+    return arrays
+
+
+def read_csvs(files: list) -> pd.DataFrame:
+    na = ["", "NaN"]
+    return pd.concat(
+        (pd.read_csv(file, na_values=na, keep_default_na=False) for file in files),
+        ignore_index=True,
+    )
+
+
+def path(directory: str, source: str, kind: str = "songs") -> str:
+    """Returns the folder holding the snapshot of the given source checksum."""
+    return os.path.join(directory, f"{kind}-v{VERSION}-{source[:16]}")
+
+
+def write(directory: str, arrays: dict, source: str, kind: str = "songs") -> str:
+    """Writes arrays as .npy files plus a manifest and removes older snapshots.
+
+    Snapshots are never modified in place, so other workers can keep the
+    files of an older one memory mapped while a new one is written.
+    """
+    target = path(directory, source, kind)
+    staging = f"{target}.{os.getpid()}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(staging, name + ".npy"), array)
+
+    manifest = {
+        "version": VERSION,
+        "kind": kind,
+        "source": source,
+        "rows": len(arrays["ids"]),
+        "arrays": list(arrays),
+    }
+    with open(os.path.join(staging, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    try:
+        os.replace(staging, target)
+    except OSError:
+        # Another worker has written the same snapshot first
+        shutil.rmtree(staging, ignore_errors=True)
+
+    for entry in os.listdir(directory):
+        if (
+            entry.startswith(kind + "-")
+            and entry != os.path.basename(target)
+            and not entry.endswith(".tmp")
+        ):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    return target
+
+
+def read_manifest(target: str) -> dict | None:
+    try:
+        with open(os.path.join(target, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load(target: str, mmap: bool = False) -> dict:
+    """Loads the arrays of a snapshot, read-only memory mapped when mmap is set."""
+    mmap_mode = "r" if mmap else None
+    names = read_manifest(target)["arrays"]
+    return {
+        name: np.load(os.path.join(target, name + ".npy"), mmap_mode=mmap_mode)
+        for name in names
+    }
+
+
+def build(
+    files: list, directory: str, kinds=tuple(KINDS), source: str | None = None
+) -> list[str]:
+    """Builds the snapshots of the given kinds from one parse of the CSV files.
+
+    Returns their folders. source is the checksum of the files when known.
+    """
+    source = source or checksum(files)
+    songs = read_csvs(files)
+    return [write(directory, KINDS[kind](songs), source, kind) for kind in kinds]
+
+
+def load_or_build(
+    files: list,
+    directory: str,
+    mmap: bool = False,
+    kind: str = "songs",
+    source: str | None = None,
+) -> dict:
+    """Loads the snapshot of the CSV files, building it when there is none."""
+    source = source or checksum(files)
+    target = path(directory, source, kind)
+    if read_manifest(target) is None:
+        [target] = build(files, directory, [kind], source)
+    return load(target, mmap)
+
+
+def load_or_build_codes(
+    files: list,
+    directory: str,
+    precision: str,
+    mmap: bool = False,
+    source: str | None = None,
+) -> dict:
+    """Loads the int16 or int8 codes of the song snapshot, quantizing when missing.
+
+    They are kept as a snapshot of their own kind, so a deployment can scan
+    them without holding the float32 features in memory.
+    """
+    source = source or checksum(files)
+    kind = "codes-" + precision
+    target = path(directory, source, kind)
+    if read_manifest(target) is None:
+        songs = load_or_build(files, directory, True, source=source)
+        codes, scale, offset = engine.quantize(songs["features"], precision)
+        arrays = {"ids": songs["ids"], "codes": codes, "scale": scale}
+        target = write(directory, dict(arrays, offset=offset), source, kind)
+    return load(target, mmap)
+
+
+if __name__ == "__main__":
+    from app.utils.config import settings
+
+    print("Building catalog snapshots..")
+    for target in build(settings.songfiles, settings.snapshot_dir):
+        manifest = read_manifest(target)
+        print(f"Done! Wrote {manifest['rows']} {manifest['kind']} to {target}")
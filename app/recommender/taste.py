@@ -0,0 +1,70 @@
+import numpy as np
+
+from app.recommender import engine
+
+
+def song_vector(song) -> np.ndarray:
+    """Returns the normalized features of a Song model, as the catalog holds them."""
+    features = [[getattr(song, name) for name in engine.FEATURES]]
+    return engine.normalize(features)[0].astype(np.float64)
+
+
+def read_sum(profile) -> np.ndarray:
+    if not profile.vector_sum:
+        return np.zeros(len(engine.FEATURES))
+    return np.frombuffer(profile.vector_sum, dtype=np.float64)
+
+
+def centroid(profile) -> np.ndarray | None:
+    """Returns the unit length taste vector of a profile, None when it is empty."""
+    if not profile.count:
+        return None
+    return np.frombuffer(profile.centroid, dtype=np.float32)
+
+
+def update(profile, vectors: list, sign: int = 1):
+    """Adds the song vectors to a TasteProfile, or removes them with sign -1.
+
+    The sum is kept in float64 so adding and removing songs does not drift,
+    and is reset once the last song is removed.
+    """
+    total = read_sum(profile) + sign * np.sum(vectors, axis=0)
+    profile.count = (profile.count or 0) + sign * len(vectors)
+    if profile.count <= 0:
+        profile.count = 0
+        total = np.zeros(len(engine.FEATURES))
+    profile.vector_sum = total.tobytes()
+    # Scoring against the normalized sum gives the centroid ranking
+    profile.centroid = engine.normalize([total])[0].tobytes()
+
+
+def standardized(profile, mean: np.ndarray, std: np.ndarray) -> np.ndarray | None:
+    """Returns the unit length mean song of a profile in catalog z-scores.
+
+    Normalized features all lie in a narrow cone, so raw centroids of any
+    two tastes are nearly parallel. Centering and scaling every column by
+    the catalog's mean and deviation compares how tastes differ from the
+    average song instead. None when the profile is empty.
+    """
+    if not profile.count:
+        return None
+    return engine.normalize([(read_sum(profile) / profile.count - mean) / std])[0]
+
+
+def similarities(profile, others: list, mean: np.ndarray, std: np.ndarray) -> list:
+    """Returns the cosine similarity of a profile's taste to each of others.
+
+    Tastes are compared standardized by the catalog mean and std, all with
+    one matrix product; None stands for a comparison with an empty profile.
+    """
+    mine = standardized(profile, mean, std)
+    vectors = [standardized(other, mean, std) for other in others]
+    known = [i for i, vector in enumerate(vectors) if vector is not None]
+    scores = [None] * len(others)
+    if mine is None or not known:
+        return scores
+
+    matrix = np.stack([vectors[i] for i in known])
+    for i, score in zip(known, (matrix @ mine).tolist()):
+        scores[i] = score
+    return scores
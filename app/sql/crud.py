@@ -1,8 +1,13 @@
+from collections import defaultdict
 from uuid import uuid4
 
 from fastapi import HTTPException
+from sqlalchemy import func, select, union_all
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
 
+from ..recommender import cache, catalog, collaborative, engine, snapshot, taste
 from ..utils import security
 from . import models, schemas
 
@@ -33,6 +38,8 @@ def create_user(db: Session, user: schemas.UserCreate):
     db_starred = models.Starred(id=db_user.id)
     db.add(db_user)
     db.add(db_starred)
+    db.flush()
+    db.add(models.TasteProfile(user_id=db_user.id, count=0))
     db.commit()
     db.refresh(db_user)
     return db_user
@@ -144,8 +151,8 @@ def get_songs(db: Session, skip: int, limit: int):
     return db.query(models.Song).offset(skip).limit(limit).all()
 
 
-def get_all_defualt_songs(db: Session):
-    return db.query(models.Song).filter(models.Song.owner_id == 0).all()
+def get_all_user_songs(db: Session):
+    return db.query(models.Song).filter(models.Song.owner_id != 0).all()
 
 
 def get_songs_recent(db: Session, skip: int, limit: int):
@@ -169,6 +176,13 @@ def get_song_by_id(db: Session, id: str):
     return db.query(models.Song).filter(models.Song.id == id).first()
 
 
+def get_songs_by_ids(db: Session, ids: list[str]):
+    """Retrieves the songs with the given ids in the order of ids."""
+    songs = db.query(models.Song).filter(models.Song.id.in_(ids)).all()
+    songs_by_id = {song.id: song for song in songs}
+    return [songs_by_id[id] for id in ids if id in songs_by_id]
+
+
 def get_songs_by_album_id(db: Session, album_id: str):
     return db.query(models.Song).filter(models.Song.album_id == album_id).all()
 
@@ -207,9 +221,17 @@ def delete_song(db: Session, id: str, owner_id: int):
 
     album = db.query(models.Album).filter(models.Album.id == song.album_id).first()
 
-    album.number_of_tracks -= 1
-    db.delete(song)
-    db.commit()
+    def change():
+        album.number_of_tracks -= 1
+        owner_ids = unstar_deleted_songs(db, [song])
+        db.delete(song)
+        return owner_ids
+
+    owner_ids = commit_profile_change(db, change)
+    for starred_id in owner_ids:
+        cache.recommendations.invalidate("starred", starred_id)
+    collaborative.mark_changed()
+    catalog.remove_songs([id])
     db.refresh(album)
 
 
@@ -234,6 +256,7 @@ def create_song(db: Session, song: schemas.SongCreate, owner_id: int):
     db.add(db_song)
     db.commit()
     db.refresh(db_song)
+    catalog.add_songs([db_song])
     return db_song
 
 
@@ -269,6 +292,17 @@ def get_album_by_id(db: Session, id: str):
     return db.query(models.Album).filter(models.Album.id == id).first()
 
 
+def get_albums_by_ids(db: Session, ids: list[str]):
+    """Retrieves the albums with the given ids in the order of ids."""
+    albums = db.query(models.Album).filter(models.Album.id.in_(ids)).all()
+    albums_by_id = {album.id: album for album in albums}
+    return [albums_by_id[id] for id in ids if id in albums_by_id]
+
+
+def get_all_user_albums(db: Session):
+    return db.query(models.Album).filter(models.Album.owner_id != 0).all()
+
+
 def search_albums_by_name(db: Session, name: str, skip: int, limit: int):
     return (
         db.query(models.Album)
@@ -301,11 +335,21 @@ def delete_album(db: Session, id: str, owner_id: int):
             detail="Cannot delete a album that is not registered by you",
         )
 
-    for song in get_songs_by_album_id(db, id):
-        db.delete(song)
+    songs = get_songs_by_album_id(db, id)
 
-    db.delete(album)
-    db.commit()
+    def change():
+        owner_ids = unstar_deleted_songs(db, songs)
+        for song in songs:
+            db.delete(song)
+        db.delete(album)
+        return owner_ids
+
+    owner_ids = commit_profile_change(db, change)
+    for starred_id in owner_ids:
+        cache.recommendations.invalidate("starred", starred_id)
+    collaborative.mark_changed()
+    catalog.remove_songs([song.id for song in songs])
+    catalog.remove_albums([id])
 
 
 def create_album(db: Session, album: schemas.AlbumCreate, owner_id: int):
@@ -374,6 +418,8 @@ def delete_playlist(db: Session, id: int, owner_id: int):
 
     db.delete(playlist)
     db.commit()
+    cache.recommendations.invalidate("playlist", playlist.id)
+    collaborative.mark_changed()
     return True
 
 
@@ -402,6 +448,8 @@ def add_song_to_playlist(db: Session, id: int, song_id: str, owner_id: str):
 
     playlist.songs.append(song)
     db.commit()
+    cache.recommendations.invalidate("playlist", playlist.id)
+    collaborative.mark_changed()
     db.refresh(playlist)
     return playlist
 
@@ -431,6 +479,8 @@ def remove_song_from_playlist(db: Session, id: int, song_id: str, owner_id: int)
 
     playlist.songs.remove(song)
     db.commit()
+    cache.recommendations.invalidate("playlist", playlist.id)
+    collaborative.mark_changed()
     db.refresh(playlist)
     return playlist
 
@@ -439,6 +489,16 @@ def get_playlists(db: Session, skip: int, limit: int):
     return db.query(models.Playlist).offset(skip).limit(limit).all()
 
 
+def get_playlist_song_ids_by_owner_id(db: Session, owner_id: int) -> list[str]:
+    rows = (
+        db.query(models.playlist_song_association.c.song_id)
+        .join(models.Playlist)
+        .filter(models.Playlist.owner_id == owner_id)
+        .distinct()
+    )
+    return [song_id for (song_id,) in rows]
+
+
 # Starred Debug
 
 
@@ -457,55 +517,275 @@ def is_starred(db: Session, id: str, owner_id: str):
 
 
 def star_song(db: Session, id: str, owner_id: str):
-    starred = db.query(models.Starred).filter(models.Starred.id == owner_id).first()
+    def change():
+        starred = db.query(models.Starred).filter(models.Starred.id == owner_id).first()
 
-    if not starred:
-        raise HTTPException(status_code=404, detail=f"Invalid user id: {owner_id}")
+        if not starred:
+            raise HTTPException(status_code=404, detail=f"Invalid user id: {owner_id}")
 
-    song = db.query(models.Song).filter(models.Song.id == id).first()
+        song = db.query(models.Song).filter(models.Song.id == id).first()
 
-    if not song:
-        raise HTTPException(status_code=404, detail=f"Invalid song id: {id}")
+        if not song:
+            raise HTTPException(status_code=404, detail=f"Invalid song id: {id}")
 
-    if song in starred.songs:
-        raise HTTPException(
-            status_code=400,
-            detail="Song is already starred",
-        )
+        if song in starred.songs:
+            raise HTTPException(
+                status_code=400,
+                detail="Song is already starred",
+            )
 
-    starred.songs.append(song)
-    db.commit()
+        profile = get_taste_profile(db, owner_id, create=True)
+        if catalog.has_features(song):
+            taste.update(profile, [taste.song_vector(song)])
+        starred.songs.append(song)
+        return starred
+
+    starred = commit_profile_change(db, change)
+    cache.recommendations.invalidate("starred", starred.id)
+    collaborative.mark_changed()
     db.refresh(starred)
     return starred
 
 
 def unstar_song(db: Session, id: str, owner_id: int):
-    starred = db.query(models.Starred).filter(models.Starred.id == owner_id).first()
+    def change():
+        starred = db.query(models.Starred).filter(models.Starred.id == owner_id).first()
 
-    if not starred:
-        raise HTTPException(status_code=404, detail=f"Invalid user id: {owner_id}")
+        if not starred:
+            raise HTTPException(status_code=404, detail=f"Invalid user id: {owner_id}")
 
-    song = db.query(models.Song).filter(models.Song.id == id).first()
+        song = db.query(models.Song).filter(models.Song.id == id).first()
 
-    if not song:
-        raise HTTPException(status_code=404, detail=f"Invalid song id: {id}")
+        if not song:
+            raise HTTPException(status_code=404, detail=f"Invalid song id: {id}")
 
-    if song not in starred.songs:
-        raise HTTPException(
-            status_code=400,
-            detail="Song is not starred",
-        )
+        if song not in starred.songs:
+            raise HTTPException(
+                status_code=400,
+                detail="Song is not starred",
+            )
 
-    starred.songs.remove(song)
-    db.commit()
+        profile = get_taste_profile(db, owner_id, create=True)
+        if catalog.has_features(song):
+            taste.update(profile, [taste.song_vector(song)], -1)
+        starred.songs.remove(song)
+        return starred
+
+    starred = commit_profile_change(db, change)
+    cache.recommendations.invalidate("starred", starred.id)
+    collaborative.mark_changed()
     db.refresh(starred)
     return starred
 
 
+def commit_profile_change(db: Session, change, attempts: int = 5):
+    """Runs change and commits it, returning what change returned.
+
+    Taste profiles are versioned, so a commit fails when a concurrent request
+    updated one of the profiles change read. change then runs again on the
+    fresh rows, so no star is added to or removed from a profile twice.
+    """
+    for _ in range(attempts):
+        result = change()
+        try:
+            db.commit()
+            return result
+        except StaleDataError:
+            db.rollback()
+    raise HTTPException(
+        status_code=409, detail="Stars changed concurrently, please try again"
+    )
+
+
 def get_starred(db: Session, owner_id: int):
     return db.query(models.Starred).filter(models.Starred.id == owner_id).first()
 
 
+def get_taste_profile(
+    db: Session, owner_id: int, create: bool = False
+) -> models.TasteProfile:
+    """Returns the taste profile of a user.
+
+    Users who starred songs before profiles existed get one computed from
+    their stars, which is only stored with create, when a star is changed.
+    star_song and unstar_song keep it up to date afterwards.
+    """
+    profile = db.get(models.TasteProfile, owner_id)
+    if profile:
+        return profile
+
+    profile = models.TasteProfile(user_id=owner_id, count=0)
+    starred = get_starred(db, owner_id)
+    songs = [
+        song
+        for song in (starred.songs if starred else [])
+        if catalog.has_features(song)
+    ]
+    if songs:
+        taste.update(profile, [taste.song_vector(song) for song in songs])
+    if not create:
+        return profile
+
+    try:
+        db.add(profile)
+        db.flush()
+    except IntegrityError:
+        # Stored by a concurrent request meanwhile
+        db.rollback()
+        profile = db.get(models.TasteProfile, owner_id)
+    return profile
+
+
+def unstar_deleted_songs(db: Session, songs: list[models.Song]) -> set[int]:
+    """Unstars songs about to be deleted, taking them out of taste profiles.
+
+    Returns the ids of the star lists they were in. Nothing is committed, so
+    it happens in the transaction deleting the songs.
+    """
+    starred = models.starred_song_association
+    ids = [song.id for song in songs]
+    vectors = {
+        song.id: taste.song_vector(song) for song in songs if catalog.has_features(song)
+    }
+    removed = defaultdict(list)
+    owner_ids = set()
+    for starred_id, song_id in db.query(starred.c.starred_id, starred.c.song_id).filter(
+        starred.c.song_id.in_(ids)
+    ):
+        owner_ids.add(starred_id)
+        if song_id in vectors:
+            removed[starred_id].append(vectors[song_id])
+
+    profiles = db.query(models.TasteProfile).filter(
+        models.TasteProfile.user_id.in_(removed)
+    )
+    for profile in profiles:
+        taste.update(profile, removed[profile.user_id], -1)
+    db.execute(starred.delete().where(starred.c.song_id.in_(ids)))
+    return owner_ids
+
+
+def get_starred_song_ids_by_owner_ids(db: Session, owner_ids: list[int]) -> list[str]:
+    rows = (
+        db.query(models.starred_song_association.c.song_id)
+        .filter(models.starred_song_association.c.starred_id.in_(owner_ids))
+        .distinct()
+    )
+    return [song_id for (song_id,) in rows]
+
+
+def get_taste_profiles(
+    db: Session, owner_ids: list[int]
+) -> dict[int, models.TasteProfile]:
+    """Returns the taste profiles of several users, see get_taste_profile."""
+    profiles = {
+        profile.user_id: profile
+        for profile in db.query(models.TasteProfile).filter(
+            models.TasteProfile.user_id.in_(owner_ids)
+        )
+    }
+    for owner_id in set(owner_ids) - profiles.keys():
+        profiles[owner_id] = get_taste_profile(db, owner_id)
+    return profiles
+
+
+def get_starred_overlaps(
+    db: Session, owner_id: int, other_ids: list[int]
+) -> dict[int, float]:
+    """Returns the Jaccard index of the starred songs of a user and each other.
+
+    Both the star counts and the shared stars are counted by the database.
+    """
+    starred = models.starred_song_association
+    counts = dict(
+        db.query(starred.c.starred_id, func.count(func.distinct(starred.c.song_id)))
+        .filter(starred.c.starred_id.in_([owner_id, *other_ids]))
+        .group_by(starred.c.starred_id)
+    )
+    mine, theirs = starred.alias(), starred.alias()
+    shared = dict(
+        db.query(theirs.c.starred_id, func.count(func.distinct(theirs.c.song_id)))
+        .join(mine, mine.c.song_id == theirs.c.song_id)
+        .filter(mine.c.starred_id == owner_id, theirs.c.starred_id.in_(other_ids))
+        .group_by(theirs.c.starred_id)
+    )
+
+    overlaps = {}
+    for other_id in other_ids:
+        union = counts.get(owner_id, 0) + counts.get(other_id, 0)
+        union -= shared.get(other_id, 0)
+        overlaps[other_id] = shared.get(other_id, 0) / union if union else 0.0
+    return overlaps
+
+
+def get_starred_song_ids(db: Session, owner_id: int) -> list[str]:
+    rows = db.query(models.starred_song_association.c.song_id).filter(
+        models.starred_song_association.c.starred_id == owner_id
+    )
+    return [song_id for (song_id,) in rows]
+
+
+# Catalog
+
+
+def feature_filters(model: type[models.Song] | type[models.Album]) -> list:
+    return [getattr(model, name).is_not(None) for name in engine.FEATURES]
+
+
+def get_feature_row_count(
+    db: Session, model: type[models.Song] | type[models.Album]
+) -> tuple[int, int]:
+    """Returns the number of rows with audio features and their longest id."""
+    count, id_length = (
+        db.query(func.count(model.id), func.max(func.length(model.id)))
+        .filter(*feature_filters(model))
+        .one()
+    )
+    return count, id_length or 0
+
+
+def stream_feature_rows(
+    db: Session, model: type[models.Song] | type[models.Album], chunk: int = 8192
+):
+    """Yields the rows with audio features in lists of chunk rows.
+
+    Only the id, features and snapshot columns are selected and the cursor
+    is read chunk by chunk, no ORM object is created.
+    """
+    columns = [
+        model.id,
+        *(getattr(model, name) for name in engine.FEATURES),
+        *(getattr(model, name) for name in snapshot.COLUMNS),
+    ]
+    result = (
+        db.connection()
+        .execution_options(yield_per=chunk)
+        .execute(select(*columns).where(*feature_filters(model)))
+    )
+    yield from result.partitions()
+
+
+def stream_collection_songs(db: Session, chunk: int = 65536):
+    """Yields the (collection, song id) rows of all star lists and playlists.
+
+    Star lists are numbered 2 * id and playlists 2 * id + 1, so both kinds of
+    collections share one numbering. Rows left behind by deleted playlists
+    or songs are skipped.
+    """
+    starred = models.starred_song_association.c
+    playlist = models.playlist_song_association.c
+    query = union_all(
+        select(starred.starred_id * 2, starred.song_id)
+        .join(models.Song)
+        .where(starred.starred_id.is_not(None)),
+        select(playlist.playlist_id * 2 + 1, playlist.song_id)
+        .join(models.Playlist)
+        .join(models.Song),
+    )
+    result = db.connection().execution_options(yield_per=chunk).execute(query)
+    yield from result.partitions()
+
+
 # Debug
 
 
@@ -514,6 +794,7 @@ def create_song_debug(db: Session, song: schemas.SongDebug):
     db.add(db_song)
     db.commit()
     db.refresh(db_song)
+    catalog.add_songs([db_song])
     return db_song
 
 
@@ -522,4 +803,5 @@ def create_album_debug(db: Session, album: schemas.AlbumDebug):
     db.add(db_song)
     db.commit()
     db.refresh(db_song)
+    catalog.add_albums([db_song])
     return db_song
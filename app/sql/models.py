@@ -1,4 +1,13 @@
-from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, String, Table
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Float,
+    ForeignKey,
+    Integer,
+    LargeBinary,
+    String,
+    Table,
+)
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import relationship
 
@@ -54,6 +63,21 @@ class User(Base):
     )
 
 
+# Running sum of the normalized features of a user's starred songs with
+# audio features, see app.recommender.taste
+class TasteProfile(Base):
+    __tablename__ = "taste_profiles"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    count = Column(Integer, default=0)
+    vector_sum = Column(LargeBinary, nullable=True)
+    centroid = Column(LargeBinary, nullable=True)
+    # Bumped by every update, which fails when another one committed first
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {"version_id_col": version}
+
+
 class Song(Base):
     __tablename__ = "songs"
 
@@ -3,7 +3,7 @@ from datetime import datetime
 
 from email_validator import EmailNotValidError, validate_email
 from fastapi import HTTPException
-from pydantic import BaseModel, ConfigDict, ValidationInfo, field_validator
+from pydantic import BaseModel, ConfigDict, Field, ValidationInfo, field_validator
 
 # User Schemas
 
@@ -78,6 +78,15 @@ class User(UserBase):
     model_config = ConfigDict(from_attributes=True)
 
 
+class FriendCompatibility(BaseModel):
+    id: int
+    username: str
+    # Cosine similarity of the taste profiles, None if either is empty
+    taste_similarity: float | None
+    # Jaccard index of the starred songs
+    starred_overlap: float
+
+
 # Friend Request Schema
 
 
@@ -105,6 +114,22 @@ class SongBase(BaseModel):
 
 
 class SongCreate(SongBase):
+    # Optional audio features, songs with all of them are recommendable
+    explicit: bool | None = None
+    danceability: float | None = None
+    energy: float | None = None
+    key: int | None = None
+    loudness: float | None = None
+    mode: int | None = None
+    speechiness: float | None = None
+    acousticness: float | None = None
+    instrumentalness: float | None = None
+    liveness: float | None = None
+    valence: float | None = None
+    tempo: float | None = None
+    duration_ms: int | None = None
+    time_signature: int | None = None
+
     @field_validator("day")
     def validate_date(cls, v, values):
         year = values.data["year"]
@@ -153,6 +178,45 @@ class Song(SongBase):
     model_config = ConfigDict(from_attributes=True)
 
 
+# Recommend Schemas
+
+
+class RecommendFilters(BaseModel):
+    year_min: int | None = None
+    year_max: int | None = None
+    explicit: bool | None = None
+    key: int | None = None
+    mode: int | None = None
+    time_signature: int | None = None
+    # Need a signed in user
+    exclude_starred: bool = False
+    exclude_playlists: bool = False
+
+
+# Most songs one recommend request or batch seed may ask for
+RECOMMEND_LIMIT = 100
+
+
+class RecommendPage(BaseModel):
+    # Starts paging, the next page is sent as a cursor in X-Next-Cursor
+    paginate: bool = False
+    cursor: str | None = None
+
+
+class RecommendSeed(BaseModel):
+    id: str
+    recommend: int = Field(10, ge=1, le=RECOMMEND_LIMIT)
+
+
+class RecommendBatch(BaseModel):
+    seeds: list[RecommendSeed] = Field(min_length=1, max_length=100)
+
+
+class RecommendBatchResult(BaseModel):
+    id: str
+    songs: list[Song]
+
+
 # Album Schemas
 
 
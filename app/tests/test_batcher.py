@@ -0,0 +1,44 @@
+import threading
+
+import numpy as np
+
+from app.recommender import engine, index
+from app.recommender.batcher import QueryBatcher
+
+rng = np.random.default_rng(0)
+features = engine.normalize(rng.random((1000, 10)))
+songs = index.SongIndex(np.arange(1000).astype(np.bytes_), features)
+
+
+def test_disabled():
+    batcher = QueryBatcher(0, 32)
+    rows, _ = batcher.search(songs, features[0], 5, [0])
+
+    assert rows.tolist() == songs.search(features[0], 5, [0])[0].tolist()
+
+
+def test_batch():
+    batcher = QueryBatcher(1, 8)
+    batches = []
+    search_many = songs.search_many
+
+    def record(queries, k, excludes):
+        batches.append(len(queries))
+        return search_many(queries, k, excludes)
+
+    songs.search_many = record
+    results = [None] * 8
+
+    def request(i: int):
+        results[i] = batcher.search(songs, features[i], i + 1, [i])
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    del songs.search_many
+
+    assert batches == [8]
+    for i, (rows, _) in enumerate(results):
+        assert rows.tolist() == songs.search(features[i], i + 1, [i])[0].tolist()
@@ -0,0 +1,17 @@
+import json
+
+from app.recommender import benchmark
+
+
+def test_suite():
+    report = benchmark.suite(
+        [2000], benchmark.MODES, benchmark.QUERIES, queries=8, batch=4
+    )
+
+    assert len(report["results"]) == len(benchmark.MODES) * len(benchmark.QUERIES)
+    for result in report["results"]:
+        assert result["p50_ms"] <= result["p99_ms"]
+        assert result["qps"] > 0
+        if result["mode"] == "exact":
+            assert result["recall"] == 1.0
+    assert json.loads(json.dumps(report)) == report
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from pytest import raises
+
+from app.recommender.cache import CursorStore, RecommendationCache
+
+from .test_client import auth_headers, client
+from .test_recommend import songs
+
+
+def test_hit_and_miss():
+    cache = RecommendationCache(10, 60)
+
+    assert cache.get_or_compute(("song", "a"), (10,), lambda: ["b"]) == ["b"]
+    assert cache.get_or_compute(("song", "a"), (10,), lambda: ["c"]) == ["b"]
+    assert cache.get_or_compute(("song", "a"), (5,), lambda: ["c"]) == ["c"]
+    assert cache.stats() == {
+        "size": 2,
+        "capacity": 10,
+        "hits": 1,
+        "misses": 2,
+        "evictions": 0,
+    }
+
+
+def test_eviction():
+    cache = RecommendationCache(2, 60)
+    for id in ["a", "b", "c"]:
+        cache.get_or_compute(("song", id), (10,), lambda: [id])
+
+    assert cache.get_or_compute(("song", "a"), (10,), lambda: ["new"]) == ["new"]
+    assert cache.stats()["evictions"] == 2
+
+
+def test_ttl():
+    cache = RecommendationCache(2, 0)
+    cache.get_or_compute(("song", "a"), (10,), lambda: ["b"])
+
+    assert cache.get_or_compute(("song", "a"), (10,), lambda: ["c"]) == ["c"]
+
+
+def test_invalidate():
+    cache = RecommendationCache(10, 60)
+    cache.get_or_compute(("starred", 1), (10, "max"), lambda: ["a"])
+    cache.get_or_compute(("starred", 1), (5, "max"), lambda: ["a"])
+    cache.get_or_compute(("starred", 2), (10, "max"), lambda: ["a"])
+
+    cache.invalidate("starred", 1)
+
+    assert cache.stats()["size"] == 1
+    assert cache.get_or_compute(("starred", 1), (10, "max"), lambda: ["b"]) == ["b"]
+
+
+def test_error_not_cached():
+    cache = RecommendationCache(10, 60)
+
+    def fail():
+        raise ValueError
+
+    with raises(ValueError):
+        cache.get_or_compute(("song", "a"), (10,), fail)
+    assert cache.get_or_compute(("song", "a"), (10,), lambda: ["b"]) == ["b"]
+
+
+def test_collapse_misses():
+    cache = RecommendationCache(10, 60)
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return ["b"]
+
+    def request():
+        results.append(cache.get_or_compute(("song", "a"), (10,), compute))
+
+    threads = [threading.Thread(target=request) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [["b"]] * 5
+
+
+def test_invalidate_while_computing():
+    cache = RecommendationCache(10, 60)
+
+    def compute():
+        cache.invalidate("starred", 1)
+        return ["a"]
+
+    assert cache.get_or_compute(("starred", 1), (10,), compute) == ["a"]
+    assert cache.stats()["size"] == 0
+
+
+def test_playlist_invalidation(auth_headers: auth_headers, songs: songs):
+    response = client.post("/playlists", headers=auth_headers[0], json={"name": "Mix"})
+    id = str(response.json()["id"])
+    client.put(f"/playlists/{id}/a", headers=auth_headers[0])
+    before = client.get("/recommend/playlist/" + id + "?recommend=2")
+
+    client.put(f"/playlists/{id}/d", headers=auth_headers[0])
+    after = client.get("/recommend/playlist/" + id + "?recommend=2")
+
+    deleted = client.delete("/playlists/" + id, headers=auth_headers[0])
+
+    assert deleted.status_code == 200
+    assert [song["id"] for song in before.json()] == ["b", "c"]
+    assert [song["id"] for song in after.json()] == ["e", "c"]
+
+
+def test_cursors():
+    cursors = CursorStore(2, 60)
+    key = cursors.create(("song", "a"), ["b", "c", "d"])
+
+    assert cursors.read(f"{key}.2", ("song", "a")) == (key, ["b", "c", "d"], 2)
+    assert cursors.read(f"{key}.2", ("song", "b")) is None
+    assert cursors.read(f"{key}.x", ("song", "a")) is None
+    assert cursors.read(key, ("song", "a")) is None
+
+    for id in ["b", "c"]:
+        cursors.create(("song", id), [id])
+    assert cursors.read(f"{key}.2", ("song", "a")) is None
+
+
+def test_cursor_expiry():
+    cursors = CursorStore(2, 0)
+    key = cursors.create(("song", "a"), ["b"])
+
+    assert cursors.read(f"{key}.0", ("song", "a")) is None
+    assert CursorStore(0, 60).create(("song", "a"), ["b"]) is None
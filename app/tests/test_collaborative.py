@@ -0,0 +1,53 @@
+import numpy as np
+
+from app.recommender import collaborative
+
+
+def co_occurrence():
+    # Collection 0 holds a, b and c, collection 1 holds a and b, 2 holds c and d
+    collections = np.array([0, 0, 0, 1, 1, 1, 2, 2])
+    songs = np.array(["a", "b", "c", "a", "b", "b", "c", "d"])
+    return collaborative.CoOccurrence.build(collections, songs)
+
+
+def test_build():
+    similarities = co_occurrence()
+
+    assert similarities.ids.tolist() == ["a", "b", "c", "d"]
+    assert np.allclose(
+        similarities.matrix.toarray(),
+        [
+            [0, 1, 0.5, 0],
+            [1, 0, 0.5, 0],
+            [0.5, 0.5, 0, 0.5**0.5],
+            [0, 0, 0.5**0.5, 0],
+        ],
+    )
+
+
+def test_similar():
+    similarities = co_occurrence()
+
+    ids, scores = similarities.similar("c", 2)
+
+    assert ids == ["d", "a"]
+    assert np.allclose(scores, [0.5**0.5, 0.5])
+    assert similarities.similar("c", 3, ["d"])[0] == ["a", "b"]
+    assert similarities.similar("e", 3)[0] == []
+
+
+def test_blend():
+    audio = {"a": 0.9, "b": 0.7, "c": 0.8}
+    scores = {"c": 1.0, "d": 0.5}
+
+    assert collaborative.blend(audio, scores, 0, 2) == ["a", "c"]
+    assert collaborative.blend(audio, scores, 1, 2) == ["c", "d"]
+    assert collaborative.blend(audio, scores, 0.5, 2) == ["c", "a"]
+
+
+def test_pairs():
+    collections, songs = collaborative.pairs([[(0, "a"), (1, "b")], [], [(1, "c")]])
+
+    assert collections.tolist() == [0, 1, 1]
+    assert songs.tolist() == ["a", "b", "c"]
+    assert len(collaborative.pairs([])[0]) == 0
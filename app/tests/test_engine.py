@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app.recommender import engine
+
+
+def test_normalize():
+    matrix = engine.normalize([[3.0, 4.0], [0.0, 0.0], [np.nan, 2.0]])
+
+    assert matrix.dtype == np.float32
+    assert np.allclose(matrix, [[0.6, 0.8], [0.0, 0.0], [0.0, 1.0]])
+
+
+def test_top_k():
+    scores = np.array([0.1, 0.9, 0.5, 0.7, 0.3], dtype=np.float32)
+    indices, values = engine.top_k(scores, 3)
+
+    assert indices.tolist() == [1, 3, 2]
+    assert np.allclose(values, [0.9, 0.7, 0.5])
+
+
+def test_top_k_exclude():
+    scores = np.array([0.1, 0.9, 0.5, 0.7, 0.3], dtype=np.float32)
+    indices, _ = engine.top_k(scores, 2, [1, 2])
+
+    assert indices.tolist() == [3, 4]
+
+
+def test_top_k_ties():
+    scores = np.array([0.5, 0.9, 0.5, 0.5, 0.1], dtype=np.float32)
+    indices, _ = engine.top_k(scores, 3)
+
+    assert indices.tolist() == [1, 0, 2]
+
+
+def test_top_k_short():
+    scores = np.array([0.1, 0.9], dtype=np.float32)
+    indices, _ = engine.top_k(scores, 5, [0])
+
+    assert indices.tolist() == [1]
+
+
+def test_score():
+    features = engine.normalize([[1, 0], [0, 1], [1, 1]])
+    queries = engine.normalize([[1, 0], [0, 1]])
+
+    assert np.allclose(engine.score(features, queries, "mean"), [0.5, 0.5, 0.7071])
+    assert np.allclose(engine.score(features, queries, "centroid"), [0.7071, 0.7071, 1])
+    assert np.allclose(engine.score(features, queries, "max", chunk=2), [1, 1, 0.7071])
+    assert np.allclose(engine.score(features, queries, "min", chunk=2), [0, 0, 0.7071])
+
+
+def test_batch_top_k():
+    rng = np.random.default_rng(0)
+    features = engine.normalize(rng.random((1000, 4)))
+    queries = features[:5]
+    excludes = [[i] for i in range(5)]
+
+    results = engine.batch_top_k(features, queries, 10, excludes, chunk=128)
+
+    for query, exclude, (rows, scores) in zip(queries, excludes, results):
+        expected, _ = engine.top_k(features @ query, 10, exclude)
+        assert rows.tolist() == expected.tolist()
+
+
+def test_sharded_top_k():
+    rng = np.random.default_rng(0)
+    # Repeated rows make ties that cross shard boundaries
+    features = engine.normalize(np.tile(rng.random((250, 4)), (4, 1)))
+    mask = rng.random(1000) < 0.5
+    exclude = [0, 250, 999]
+
+    with ThreadPoolExecutor(4) as pool:
+        for aggregate in ["centroid", "max"]:
+            queries = features[:3]
+            single = engine.sharded_top_k(
+                features, queries, 20, exclude, aggregate, mask
+            )
+            sharded = engine.sharded_top_k(
+                features, queries, 20, exclude, aggregate, mask, pool, 7
+            )
+
+            assert sharded[0].tolist() == single[0].tolist()
+            assert sharded[1].tolist() == single[1].tolist()
+            assert mask[single[0]].all()
+
+
+def test_quantize():
+    rng = np.random.default_rng(0)
+    features = engine.normalize(rng.random((1000, 4)) * 2 - 1)
+    queries = features[:3]
+
+    for precision in engine.CODES:
+        codes, scale, offset = engine.quantize(features, precision)
+        assert codes.dtype == engine.CODES[precision][0]
+        for aggregate in ["centroid", "max"]:
+            expected = engine.score(features, queries, aggregate)
+            scores = engine.score(codes, queries, aggregate, 128, scale, offset)
+            assert np.abs(scores - expected).max() < 0.02
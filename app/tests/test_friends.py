@@ -0,0 +1,121 @@
+import numpy as np
+from pytest import fixture
+
+from app.recommender import catalog, engine
+
+from .test_client import auth_headers, client
+from .test_recommend import catalog_songs, create_user_song, songs
+
+
+@fixture(scope="module")
+def friends(auth_headers: auth_headers):
+    if not client.get("/friends/", headers=auth_headers[0]).json():
+        user_id = client.get("/auth/me", headers=auth_headers[1]).json()["id"]
+        client.post(f"/friends/send/{user_id}", headers=auth_headers[0])
+        request = client.get("/friends/requests/pending", headers=auth_headers[1])
+        client.put(
+            f"/friends/requests/{request.json()[0]['id']}", headers=auth_headers[1]
+        )
+
+    yield auth_headers
+
+
+def standardized(songs: list, ids: list) -> np.ndarray:
+    features = dict(zip(songs, catalog.song_index.features))
+    mean, std = catalog.song_index.statistics()
+    taste = np.mean([features[id] for id in ids], axis=0)
+    return engine.normalize([(taste - mean) / std])[0]
+
+
+def test_compatibility(friends: friends, songs: songs):
+    stars = [["a", "b", "d"], ["a", "d", "e"]]
+    for headers, ids in zip(friends, stars):
+        for id in ids:
+            client.put("/starred/" + id, headers=headers)
+
+    response = client.get("/friends/compatibility", headers=friends[0])
+    for headers, ids in zip(friends, stars):
+        for id in ids:
+            client.delete("/starred/" + id, headers=headers)
+    empty = client.get("/friends/compatibility", headers=friends[1])
+
+    mine, theirs = [standardized(songs, ids) for ids in stars]
+    [friend] = response.json()
+    assert response.status_code == 200
+    assert friend["username"] == "yavuzil"
+    assert np.isclose(friend["taste_similarity"], mine @ theirs)
+    assert friend["starred_overlap"] == 0.5
+    assert empty.json()[0]["taste_similarity"] is None
+    assert empty.json()[0]["starred_overlap"] == 0
+
+
+def test_group(friends: friends, songs: songs):
+    client.put("/starred/a", headers=friends[0])
+    client.put("/starred/d", headers=friends[1])
+    user_id = client.get("/auth/me", headers=friends[1]).json()["id"]
+
+    least_misery = client.get(
+        f"/recommend/group?users={user_id}&recommend=4", headers=friends[0]
+    )
+    average = client.get(
+        f"/recommend/group?users={user_id}&recommend=4&strategy=average",
+        headers=friends[0],
+    )
+    alone = client.get("/recommend/group?recommend=2", headers=friends[0])
+    stranger = client.get("/recommend/group?users=1000", headers=friends[0])
+
+    client.delete("/starred/a", headers=friends[0])
+    client.delete("/starred/d", headers=friends[1])
+    empty = client.get("/recommend/group", headers=friends[1])
+
+    features = dict(zip(songs, catalog.song_index.features))
+    others = ["b", "c", "e", "f"]
+    scores = (
+        np.stack([features[id] for id in others])
+        @ np.stack([features["a"], features["d"]]).T
+    )
+    assert [song["id"] for song in least_misery.json()] == [
+        others[i] for i in np.argsort(-scores.min(axis=1), kind="stable")
+    ]
+    assert [song["id"] for song in average.json()] == [
+        others[i] for i in np.argsort(-scores.mean(axis=1), kind="stable")
+    ]
+    assert [song["id"] for song in alone.json()] == ["b", "c"]
+    assert stranger.status_code == 400
+    assert empty.status_code == 404
+
+
+def test_compatibility_deleted_star(friends: friends, songs: songs):
+    client.put("/starred/a", headers=friends[0])
+    client.put("/starred/d", headers=friends[1])
+    album_id, id = create_user_song(friends[0], catalog_songs[4])
+    client.put("/starred/" + id, headers=friends[0])
+    client.delete("/albums/" + album_id, headers=friends[0])
+
+    response = client.get("/friends/compatibility", headers=friends[0])
+    client.delete("/starred/a", headers=friends[0])
+    client.delete("/starred/d", headers=friends[1])
+
+    [friend] = response.json()
+    expected = standardized(songs, ["a"]) @ standardized(songs, ["d"])
+    assert np.isclose(friend["taste_similarity"], expected)
+    assert friend["starred_overlap"] == 0
+
+
+def test_group_deleted_star(friends: friends, songs: songs):
+    client.put("/starred/a", headers=friends[0])
+    client.put("/starred/d", headers=friends[1])
+    user_id = client.get("/auth/me", headers=friends[1]).json()["id"]
+    url = f"/recommend/group?users={user_id}&recommend=4"
+    before = client.get(url, headers=friends[0])
+
+    album_id, id = create_user_song(friends[1], catalog_songs[5])
+    client.put("/starred/" + id, headers=friends[1])
+    starred = client.get(url, headers=friends[0])
+    client.delete("/albums/" + album_id, headers=friends[1])
+    after = client.get(url, headers=friends[0])
+
+    client.delete("/starred/a", headers=friends[0])
+    client.delete("/starred/d", headers=friends[1])
+    assert starred.json() != before.json()
+    assert after.json() == before.json()
@@ -0,0 +1,33 @@
+from app.recommender import catalog
+
+from .test_client import client
+from .test_recommend import songs
+
+
+def test_live():
+    response = client.get("/health/live")
+
+    assert response.status_code == 200
+
+
+def test_ready(songs: songs):
+    response = client.get("/health/ready")
+
+    assert response.status_code == 200
+    assert response.json()["ready"] is True
+
+
+def test_not_ready(songs: songs, monkeypatch):
+    monkeypatch.setattr(catalog, "song_index", None)
+    monkeypatch.setattr(catalog, "stage", catalog.STAGES.index("albums"))
+
+    ready = client.get("/health/ready")
+    recommend = client.get("/recommend/song/a")
+    songs_response = client.get("/songs/count")
+
+    assert ready.status_code == 503
+    assert ready.json()["stage"] == "albums"
+    assert ready.json()["step"] == 2
+    assert recommend.status_code == 503
+    assert recommend.headers["Retry-After"] == "5"
+    assert songs_response.status_code == 200
@@ -0,0 +1,136 @@
+import numpy as np
+
+from app.recommender import engine, index
+
+ids = np.array([b"c", b"a", b"d", b"b"])
+features = engine.normalize([[1, 0], [0, 1], [1, 1], [1, 0.1]])
+
+
+def test_get_rows():
+    songs = index.SongIndex(ids, features)
+
+    assert songs.get_rows(["a", "b", "c", "d"]).tolist() == [1, 3, 0, 2]
+
+
+def test_get_rows_unknown():
+    songs = index.SongIndex(ids, features)
+
+    assert songs.get_rows(["e", "aa", "", "a-much-longer-id"]).tolist() == []
+    assert songs.get_rows(["e", "d"]).tolist() == [2]
+
+
+def test_get_ids():
+    songs = index.SongIndex(ids, features)
+
+    assert songs.get_ids(np.array([2, 0])) == ["d", "c"]
+
+
+def test_search():
+    songs = index.SongIndex(ids, features)
+    rows, _ = songs.search(features[0], 2, [0])
+
+    assert songs.get_ids(rows) == ["b", "d"]
+
+
+def test_search_filters():
+    years = np.array([1999, 2005, 2010, 2020], dtype=np.int16)
+    explicit = np.array([False, True, False, True])
+    songs = index.SongIndex(ids, features, year=years, explicit=explicit)
+    songs.append(
+        {
+            "ids": np.array([b"new-song"]),
+            "features": engine.normalize([[1, 0.05]]),
+            "year": np.array([2021], dtype=np.int16),
+            "explicit": np.array([True]),
+        }
+    )
+
+    rows, _ = songs.search(features[0], 3, [0], filters={"explicit": True})
+    assert songs.get_ids(rows) == ["new-song", "b", "a"]
+
+    rows, _ = songs.search(features[0], 3, [0], filters={"year": (2005, 2020)})
+    assert songs.get_ids(rows) == ["b", "d", "a"]
+
+    rows, _ = songs.search(features[0], 3, filters={"year": (None, 2000)})
+    assert songs.get_ids(rows) == ["c"]
+
+    rows, _ = songs.search(features[0], 3, filters={"key": 5})
+    assert songs.get_ids(rows) == []
+
+
+def test_ivf_recall():
+    rng = np.random.default_rng(1)
+    catalog = engine.normalize(rng.random((5000, 10)))
+    songs = index.SongIndex(np.arange(5000).astype(np.bytes_), catalog)
+    exact = [set(songs.search(query, 10)[0]) for query in catalog[:50]]
+
+    songs.build_ann(n_lists=32, nprobe=8)
+    recall = np.mean(
+        [
+            len(expected & set(songs.search(query, 10)[0])) / 10
+            for query, expected in zip(catalog[:50], exact)
+        ]
+    )
+
+    assert recall >= 0.9
+
+
+def test_ivf_fallback():
+    songs = index.SongIndex(ids, features)
+    songs.build_ann(n_lists=4, nprobe=1)
+    rows, _ = songs.search(features[0], 3, [0])
+
+    assert songs.get_ids(rows) == ["b", "d", "a"]
+
+
+def delta_songs(*names: str, features=None):
+    features = engine.normalize(features if features is not None else [[1, 0.05]])
+    return {"ids": np.array([name.encode() for name in names]), "features": features}
+
+
+def test_quantized_rerank():
+    rng = np.random.default_rng(0)
+    features = engine.normalize(rng.random((1000, 10)) * 2 - 1)
+    exact = index.SongIndex(np.arange(1000).astype(np.bytes_), features)
+    songs = index.SongIndex(exact.ids, features)
+    songs.quantize("int16")
+
+    for row in range(10):
+        expected, expected_scores = exact.search(features[row], 10, [row])
+        rows, scores = songs.search(features[row], 10, [row])
+        assert rows.tolist() == expected.tolist()
+        assert np.allclose(scores, expected_scores)
+
+
+def test_append():
+    songs = index.SongIndex(ids, features)
+    songs.append(delta_songs("new-song"))
+    songs.append(delta_songs("a"))
+
+    assert len(songs) == 5
+    assert sorted(songs.get_rows(["new-song", "a"]).tolist()) == [1, 4]
+
+    rows, _ = songs.search(features[0], 2, [0])
+    assert songs.get_ids(rows) == ["new-song", "b"]
+
+
+def test_remove():
+    songs = index.SongIndex(ids, features)
+    songs.append(delta_songs("new-song"))
+    songs.remove(["b", "new-song"])
+
+    assert len(songs) == 3
+    assert songs.get_rows(["b", "new-song"]).tolist() == []
+
+    rows, _ = songs.search(features[0], 3, [0])
+    assert songs.get_ids(rows) == ["d", "a"]
+
+
+def test_merged():
+    songs = index.SongIndex(ids, features)
+    songs.append(delta_songs("new-song", "other-song", features=[[1, 0], [0, 1]]))
+    songs.remove(["b", "other-song"])
+    merged = index.SongIndex(**songs.merged())
+
+    assert sorted(merged.get_ids(np.arange(len(merged)))) == ["a", "c", "d", "new-song"]
+    assert merged.changes[0] is None
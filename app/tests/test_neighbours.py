@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+from app.recommender import engine, index, neighbours, snapshot
+
+from .test_recommend import catalog_songs
+
+
+def random_songs(n: int):
+    features = engine.normalize(np.random.default_rng(1).random((n, 10)))
+    ids = np.array([str(i).encode() for i in range(n)])
+    return {"ids": ids, "features": features}
+
+
+def test_compute(tmp_path):
+    arrays = random_songs(1000)
+    target = snapshot.write(str(tmp_path), arrays, "source")
+
+    table = neighbours.compute(target, 5, workers=2, block=64)
+
+    scores = arrays["features"] @ arrays["features"].T
+    for row in [0, 1, 500, 999]:
+        rows, _ = engine.top_k(scores[row], 5, [row])
+        assert table[row].tolist() == rows.tolist()
+
+
+def test_build_and_load(tmp_path):
+    csv = str(tmp_path / "songs.csv")
+    pd.DataFrame(catalog_songs).to_csv(csv, index=False)
+    directory = str(tmp_path / "snapshot")
+
+    assert neighbours.load([csv], directory) is None
+
+    neighbours.build([csv], directory, 2, workers=1)
+    table = neighbours.load([csv], directory)
+
+    assert table.shape == (len(catalog_songs), 2)
+    assert table[0].tolist() == [1, 2]
+
+
+def test_lookup():
+    arrays = random_songs(200)
+    songs = index.SongIndex(**arrays)
+    songs.neighbours = np.stack(
+        [songs.search(arrays["features"][row], 10, [row])[0] for row in range(200)]
+    )
+    songs.append(random_songs(210))
+    songs.remove(["3", "205"])
+
+    for row in [0, 50, 199]:
+        rows, scores = songs.lookup(row, 5)
+        expected_rows, expected_scores = songs.search(arrays["features"][row], 5, [row])
+        assert rows.tolist() == expected_rows.tolist()
+        assert np.allclose(scores, expected_scores)
+
+    assert songs.lookup(0, 11) is None
+    assert songs.lookup(205, 5) is None
+    for k in [0, -3]:
+        rows, scores = songs.lookup(0, k)
+        assert len(rows) == len(scores) == 0
+
+
+def test_lookup_after_merge():
+    arrays = random_songs(200)
+    songs = index.SongIndex(**arrays)
+    songs.neighbours = np.stack(
+        [songs.search(arrays["features"][row], 10, [row])[0] for row in range(200)]
+    ).astype(np.int32)
+
+    # Each merge adds ten songs and drops one song of the table
+    for merge, removed in enumerate(["150", "180"]):
+        added = random_songs(200 + 10 * (merge + 1))
+        songs.append({name: array[-10:] for name, array in added.items()})
+        songs.remove([removed])
+        merged = index.SongIndex(**songs.merged())
+        merged.neighbours = songs.merged_neighbours()
+        songs = merged
+
+    assert len(songs) == 218
+    assert len(songs.neighbours) == 198
+    for row in [0, 50, 197]:
+        rows, scores = songs.lookup(row, 5)
+        expected_rows, expected_scores = songs.search(songs.features[row], 5, [row])
+        assert rows.tolist() == expected_rows.tolist()
+        assert np.allclose(scores, expected_scores)
+    assert songs.lookup(198, 5) is None
@@ -0,0 +1,544 @@
+import numpy as np
+import pandas as pd
+from pytest import fixture
+
+from app.recommender import (
+    cache,
+    catalog,
+    collaborative,
+    engine,
+    index,
+    snapshot,
+    taste,
+)
+from app.sql import crud, models, schemas
+from app.utils.config import settings
+
+from .test_client import TestingSessionLocal, auth_headers, client
+
+
+def catalog_song(id: str, danceability: float, energy: float, tempo: float, **fields):
+    song = {
+        "id": id,
+        "name": "Song " + id,
+        "album": "Catalog",
+        "album_id": "catalog",
+        "artists": "['Catalog Artist']",
+        "artist_ids": "['catalog']",
+        "track_number": 1,
+        "disc_number": 1,
+        "explicit": False,
+        "danceability": danceability,
+        "energy": energy,
+        "key": 5,
+        "loudness": -6.0,
+        "mode": 1,
+        "speechiness": 0.05,
+        "acousticness": 0.1,
+        "instrumentalness": 0.0,
+        "liveness": 0.1,
+        "valence": 0.5,
+        "tempo": tempo,
+        "duration_ms": 200000,
+        "time_signature": 4,
+        "year": 2020,
+        "month": 1,
+        "day": 1,
+    }
+    song.update(fields)
+    return song
+
+
+catalog_songs = [
+    catalog_song("a", 0.80, 0.70, 120.0),
+    catalog_song("b", 0.81, 0.70, 121.0, explicit=True),
+    catalog_song("c", 0.79, 0.60, 118.0),
+    catalog_song("d", 0.20, 0.20, 60.0),
+    catalog_song("e", 0.25, 0.30, 65.0, year=1999),
+    catalog_song("f", 0.50, 0.50, 180.0),
+]
+
+
+catalog_albums = [
+    dict(song, id="album-" + song["id"], number_of_tracks=1)
+    for song in catalog_songs[:4]
+]
+
+
+@fixture(scope="module")
+def songs():
+    for song in catalog_songs:
+        response = client.post("/debug/songs", json=song)
+        assert response.status_code == 200
+
+    catalog.load(snapshot.from_frame(pd.DataFrame(catalog_songs)))
+
+    yield [song["id"] for song in catalog_songs]
+
+    db = TestingSessionLocal()
+    db.query(models.Song).filter(models.Song.album_id == "catalog").delete()
+    db.commit()
+    db.close()
+
+
+def test_song_invalid(songs: songs):
+    response = client.get("/recommend/song/NULL")
+
+    assert response.status_code == 404
+
+
+def test_song(songs: songs):
+    response = client.get("/recommend/song/a?recommend=2")
+
+    assert response.status_code == 200
+    assert [song["id"] for song in response.json()] == ["b", "c"]
+
+
+def test_song_excludes_seed(songs: songs):
+    response = client.get("/recommend/song/d?recommend=5")
+
+    assert response.status_code == 200
+    data = [song["id"] for song in response.json()]
+    assert "d" not in data
+    assert data[0] == "e"
+
+
+def test_song_too_many(songs: songs):
+    response = client.get("/recommend/song/a?recommend=6")
+
+    assert response.status_code == 404
+
+
+def test_song_pages(songs: songs):
+    ranked = client.get("/recommend/song/a?recommend=5").json()
+
+    first = client.get("/recommend/song/a?recommend=2&paginate=true")
+    cursor = first.headers["X-Next-Cursor"]
+    second = client.get("/recommend/song/a?recommend=2&cursor=" + cursor)
+    last = client.get(
+        "/recommend/song/a?recommend=2&cursor=" + second.headers["X-Next-Cursor"]
+    )
+    other_seed = client.get("/recommend/song/b?recommend=2&cursor=" + cursor)
+    invalid = client.get("/recommend/song/a?recommend=2&cursor=NULL")
+    filtered = client.get(
+        "/recommend/song/a?recommend=2&explicit=true&cursor=" + cursor
+    )
+    blended = client.get(
+        "/recommend/song/a?recommend=2&collaborative_weight=0.5&cursor=" + cursor
+    )
+
+    pages = [first, second, last]
+    assert [song["id"] for page in pages for song in page.json()] == [
+        song["id"] for song in ranked
+    ]
+    assert [len(page.json()) for page in pages] == [2, 2, 1]
+    assert "X-Next-Cursor" not in last.headers
+    assert other_seed.status_code == 400
+    assert invalid.status_code == 400
+    assert filtered.status_code == 400
+    assert blended.status_code == 400
+
+
+def test_song_recommend_bounds(songs: songs):
+    for recommend in [0, -5, schemas.RECOMMEND_LIMIT + 1]:
+        response = client.get(f"/recommend/song/a?recommend={recommend}")
+        assert response.status_code == 422
+
+
+def test_songs_batch(songs: songs):
+    response = client.post(
+        "/recommend/songs",
+        json={"seeds": [{"id": "a", "recommend": 2}, {"id": "d", "recommend": 1}]},
+    )
+    single = client.get("/recommend/song/d?recommend=1")
+    invalid = client.post("/recommend/songs", json={"seeds": [{"id": "NULL"}]})
+    too_many = client.post("/recommend/songs", json={"seeds": [{"id": "a"}]})
+    empty = client.post("/recommend/songs", json={"seeds": []})
+    too_large = client.post(
+        "/recommend/songs",
+        json={"seeds": [{"id": "a", "recommend": schemas.RECOMMEND_LIMIT + 1}]},
+    )
+
+    assert response.status_code == 200
+    assert [result["id"] for result in response.json()] == ["a", "d"]
+    assert [song["id"] for song in response.json()[0]["songs"]] == ["b", "c"]
+    assert response.json()[1]["songs"] == single.json()
+    assert invalid.status_code == 404
+    assert too_many.status_code == 404
+    assert empty.status_code == 422
+    assert too_large.status_code == 422
+
+
+def test_song_filters(songs: songs):
+    clean = client.get("/recommend/song/a?recommend=2&explicit=false")
+    recent = client.get("/recommend/song/d?recommend=2&year_min=2000")
+    too_few = client.get("/recommend/song/a?recommend=2&year_max=2000")
+
+    assert [song["id"] for song in clean.json()] == ["c", "f"]
+    assert [song["id"] for song in recent.json()] == ["c", "a"]
+    assert too_few.status_code == 404
+
+
+def test_song_exclude_starred(auth_headers: auth_headers, songs: songs):
+    client.put("/starred/b", headers=auth_headers[0])
+    response = client.get(
+        "/recommend/song/a?recommend=2&exclude_starred=true", headers=auth_headers[0]
+    )
+    anonymous = client.get("/recommend/song/a?recommend=2&exclude_starred=true")
+    client.delete("/starred/b", headers=auth_headers[0])
+
+    assert [song["id"] for song in response.json()] == ["c", "f"]
+    assert anonymous.status_code == 401
+
+
+def read_collection_songs():
+    db = TestingSessionLocal()
+    pairs = collaborative.pairs(crud.stream_collection_songs(db, chunk=2))
+    db.close()
+    return pairs
+
+
+def test_song_collaborative(auth_headers: auth_headers, songs: songs):
+    collaborative.similarities = None
+    building = client.get("/recommend/song/a?collaborative_weight=1")
+
+    for id in ["a", "d", "f"]:
+        client.put("/starred/" + id, headers=auth_headers[0])
+    for id in ["a", "d"]:
+        client.put("/starred/" + id, headers=auth_headers[1])
+    collaborative.rebuild(read_collection_songs)
+
+    pure = client.get("/recommend/song/a?recommend=2&collaborative_weight=1")
+    too_many = client.get("/recommend/song/a?recommend=3&collaborative_weight=1")
+    blended = client.get("/recommend/song/a?recommend=2&collaborative_weight=0.5")
+    filtered = client.get(
+        "/recommend/song/a?recommend=1&collaborative_weight=1&year_min=2000"
+    )
+    invalid = client.get("/recommend/song/a?collaborative_weight=2")
+
+    for id in ["a", "d", "f"]:
+        client.delete("/starred/" + id, headers=auth_headers[0])
+    for id in ["a", "d"]:
+        client.delete("/starred/" + id, headers=auth_headers[1])
+    stale = collaborative.stale
+    collaborative.similarities = None
+
+    assert building.status_code == 503
+    assert [song["id"] for song in pure.json()] == ["d", "f"]
+    assert too_many.status_code == 404
+    assert [song["id"] for song in blended.json()] == ["f", "b"]
+    assert [song["id"] for song in filtered.json()] == ["d"]
+    assert invalid.status_code == 422
+    assert stale
+
+
+def test_song_collaborative_disabled(monkeypatch, songs: songs):
+    monkeypatch.setattr(settings, "collaborative_interval", 0)
+    response = client.get("/recommend/song/a?collaborative_weight=1")
+    audio = client.get("/recommend/song/a?recommend=2")
+
+    assert response.status_code == 400
+    assert "Retry-After" not in response.headers
+    assert audio.status_code == 200
+
+
+def test_song_collaborative_deleted(auth_headers: auth_headers, songs: songs):
+    playlist = client.post("/playlists", headers=auth_headers[0], json={"name": "Mix"})
+    album_id, id = create_user_song(auth_headers[0], catalog_songs[1])
+    for song_id in ["a", id, "d"]:
+        client.put(
+            f"/playlists/{playlist.json()['id']}/{song_id}", headers=auth_headers[0]
+        )
+    collaborative.rebuild(read_collection_songs)
+    listed = client.get("/recommend/song/a?recommend=2&collaborative_weight=1")
+
+    client.delete("/albums/" + album_id, headers=auth_headers[0])
+    stale = collaborative.stale
+    collaborative.rebuild(read_collection_songs)
+    deleted = client.get("/recommend/song/a?recommend=2&collaborative_weight=1")
+    remaining = client.get("/recommend/song/a?recommend=1&collaborative_weight=1")
+    client.delete(f"/playlists/{playlist.json()['id']}", headers=auth_headers[0])
+
+    assert sorted(song["id"] for song in listed.json()) == sorted([id, "d"])
+    assert stale
+    assert deleted.status_code == 404
+    assert [song["id"] for song in remaining.json()] == ["d"]
+
+
+def test_album(songs: songs):
+    response = client.get("/recommend/album/catalog")
+
+    assert response.status_code == 404
+
+
+@fixture(scope="module")
+def albums():
+    for album in catalog_albums:
+        response = client.post("/debug/albums", json=album)
+        assert response.status_code == 200
+
+    catalog.load_albums(snapshot.from_frame(pd.DataFrame(catalog_albums)))
+
+    yield [album["id"] for album in catalog_albums]
+
+    db = TestingSessionLocal()
+    db.query(models.Album).filter(models.Album.id.like("album-%")).delete()
+    db.commit()
+    db.close()
+
+
+def test_album_albums(albums: albums):
+    response = client.get("/recommend/album/album-a/albums?recommend=2")
+    too_many = client.get("/recommend/album/album-a/albums?recommend=4")
+
+    assert response.status_code == 200
+    assert [album["id"] for album in response.json()] == ["album-b", "album-c"]
+    assert too_many.status_code == 404
+
+
+def test_album_albums_cursor(albums: albums):
+    first = client.get("/recommend/album/album-a/albums?recommend=1&paginate=true")
+    cursor = first.headers["X-Next-Cursor"]
+    songs = client.get("/recommend/album/album-a?recommend=1&cursor=" + cursor)
+    second = client.get("/recommend/album/album-a/albums?recommend=1&cursor=" + cursor)
+
+    assert songs.status_code == 400
+    assert [album["id"] for album in second.json()] == ["album-c"]
+
+
+def test_album_albums_invalid(auth_headers: auth_headers, albums: albums):
+    album = client.post(
+        "/albums",
+        headers=auth_headers[0],
+        json={"name": "Empty", "artists": "Me", "year": 2021, "month": 6, "day": 25},
+    ).json()
+
+    invalid = client.get("/recommend/album/NULL/albums")
+    no_features = client.get(f"/recommend/album/{album['id']}/albums")
+    client.delete("/albums/" + album["id"], headers=auth_headers[0])
+
+    assert invalid.status_code == 404
+    assert no_features.status_code == 400
+
+
+def test_starred_without_auth():
+    response = client.get("/recommend/starred")
+
+    assert response.status_code == 401
+
+
+def test_starred_empty(auth_headers: auth_headers, songs: songs):
+    response = client.get("/recommend/starred", headers=auth_headers[1])
+
+    assert response.status_code == 404
+
+
+def test_starred_aggregate(auth_headers: auth_headers, songs: songs):
+    for id in ["a", "d"]:
+        client.put("/starred/" + id, headers=auth_headers[0])
+
+    centroid = client.get("/recommend/starred?recommend=2", headers=auth_headers[0])
+    maximum = client.get(
+        "/recommend/starred?recommend=2&aggregate=max", headers=auth_headers[0]
+    )
+    invalid = client.get("/recommend/starred?aggregate=NULL", headers=auth_headers[0])
+
+    for id in ["a", "d"]:
+        client.delete("/starred/" + id, headers=auth_headers[0])
+
+    assert [song["id"] for song in centroid.json()] == ["e", "c"]
+    assert [song["id"] for song in maximum.json()] == ["b", "c"]
+    assert invalid.status_code == 422
+
+
+def test_starred_taste_profile(auth_headers: auth_headers, songs: songs):
+    db = TestingSessionLocal()
+    user_id = crud.get_user_by_username(db, "ilanya").id
+    vectors = dict(zip(songs, catalog.song_index.features))
+
+    for id in ["a", "d"]:
+        client.put("/starred/" + id, headers=auth_headers[0])
+    starred = client.get("/recommend/starred?recommend=2", headers=auth_headers[0])
+    both = taste.centroid(crud.get_taste_profile(db, user_id))
+    client.delete("/starred/d", headers=auth_headers[0])
+    db.expire_all()
+    one = crud.get_taste_profile(db, user_id)
+    one_count, one_centroid = one.count, taste.centroid(one)
+
+    # Profiles missing for users who starred before they existed are backfilled
+    db.delete(one)
+    db.commit()
+    backfilled = crud.get_taste_profile(db, user_id)
+    backfilled_count, backfilled_centroid = backfilled.count, taste.centroid(backfilled)
+    client.delete("/starred/a", headers=auth_headers[0])
+    db.expire_all()
+    empty = crud.get_taste_profile(db, user_id)
+    db.close()
+
+    assert [song["id"] for song in starred.json()] == ["e", "c"]
+    assert np.allclose(both, engine.combine(np.stack([vectors["a"], vectors["d"]])))
+    assert one_count == 1
+    assert np.allclose(one_centroid, vectors["a"])
+    assert backfilled_count == 1
+    assert np.allclose(backfilled_centroid, vectors["a"])
+    assert empty.count == 0
+
+
+def test_star_concurrently(auth_headers: auth_headers, songs: songs):
+    db = TestingSessionLocal()
+    user_id = crud.get_user_by_username(db, "ilanya").id
+    # Read before another request stars a song, like a concurrent request
+    stale = crud.get_taste_profile(db, user_id, create=True)
+    client.put("/starred/b", headers=auth_headers[0])
+    crud.star_song(db, "c", user_id)
+    profile = crud.get_taste_profile(db, user_id)
+    count, vector = profile.count, taste.read_sum(profile).copy()
+    db.close()
+
+    client.delete("/starred/b", headers=auth_headers[0])
+    client.delete("/starred/c", headers=auth_headers[0])
+    features = [taste.song_vector(models.Song(**song)) for song in catalog_songs]
+    assert stale is profile
+    assert count == 2
+    assert np.allclose(vector, features[1] + features[2])
+
+
+def create_user_song(headers: dict, song: dict) -> tuple[str, str]:
+    """Uploads an album holding a song with the features of song."""
+    album = client.post(
+        "/albums",
+        headers=headers,
+        json={"name": "Demo", "artists": "Me", "year": 2021, "month": 6, "day": 25},
+    ).json()
+    song = dict(song, name="Demo", album_id=album["id"])
+    for field in ["id", "album", "artist_ids", "track_number", "disc_number"]:
+        del song[field]
+    return album["id"], client.post("/songs", headers=headers, json=song).json()["id"]
+
+
+def test_user_song(auth_headers: auth_headers, songs: songs):
+    album_id, id = create_user_song(auth_headers[0], catalog_songs[0])
+
+    from_user_song = client.get(f"/recommend/song/{id}?recommend=2")
+    to_user_song = client.get("/recommend/song/b?recommend=2")
+
+    client.delete("/albums/" + album_id, headers=auth_headers[0])
+    deleted = client.get("/recommend/song/b?recommend=2")
+
+    assert [song["id"] for song in from_user_song.json()] == ["a", "b"]
+    assert [song["id"] for song in to_user_song.json()] == ["a", id]
+    assert [song["id"] for song in deleted.json()] == ["a", "c"]
+
+
+def test_delete_starred_song(auth_headers: auth_headers, songs: songs):
+    db = TestingSessionLocal()
+    user_id = crud.get_user_by_username(db, "ilanya").id
+    album_id, id = create_user_song(auth_headers[0], catalog_songs[3])
+    client.put("/starred/" + id, headers=auth_headers[0])
+    starred = client.get("/recommend/starred?recommend=2", headers=auth_headers[0])
+
+    client.delete("/albums/" + album_id, headers=auth_headers[0])
+    deleted = client.get("/recommend/starred?recommend=2", headers=auth_headers[0])
+    profile = crud.get_taste_profile(db, user_id)
+    db.close()
+
+    assert [song["id"] for song in starred.json()] == ["d", "e"]
+    assert profile.count == 0
+    assert taste.centroid(profile) is None
+    assert deleted.status_code == 404
+
+
+def test_merge(songs: songs):
+    catalog.add_songs([models.Song(**catalog_song("g", 0.80, 0.70, 120.0))])
+    loaded_at = catalog.loaded_at
+    client.get("/recommend/song/a?recommend=2")
+    catalog.merge()
+
+    assert catalog.song_index.changes[0] is None
+    assert catalog.loaded_at != loaded_at
+    assert cache.recommendations.stats()["size"] == 0
+    assert catalog.song_index.get_rows(["g"]).tolist() == [6]
+
+
+def test_reload(tmp_path, monkeypatch, songs: songs):
+    csv = str(tmp_path / "songs.csv")
+    pd.DataFrame(catalog_songs[:4]).to_csv(csv, index=False)
+    user_song = models.Song(**catalog_song("user", 0.80, 0.70, 120.0))
+    old = catalog.song_index, catalog.album_index
+    hashed = []
+    checksum = snapshot.checksum
+    monkeypatch.setattr(
+        snapshot, "checksum", lambda files: hashed.append(files) or checksum(files)
+    )
+
+    try:
+        catalog.reload(
+            [csv], str(tmp_path / "snapshot"), False, lambda: ([user_song], [])
+        )
+
+        song_index = catalog.song_index
+        rows, _ = song_index.search(song_index.features[0], 1, [0])
+
+        assert song_index is not old[0]
+        assert len(hashed) == 1
+        assert len(song_index) == 5
+        assert song_index.get_ids(rows) == ["user"]
+        assert catalog.album_index.get_ids([0]) == ["catalog"]
+    finally:
+        catalog.song_index, catalog.album_index = old
+
+
+def test_reload_quantized(tmp_path, monkeypatch, songs: songs):
+    csv = str(tmp_path / "songs.csv")
+    pd.DataFrame(catalog_songs).to_csv(csv, index=False)
+    monkeypatch.setattr(settings, "recommend_precision", "int16")
+    old = catalog.song_index, catalog.album_index
+
+    try:
+        catalog.reload([csv], str(tmp_path / "snapshot"), False, lambda: ([], []))
+        response = client.get("/recommend/song/a?recommend=2")
+
+        assert catalog.song_index.codes.dtype == np.int16
+        assert isinstance(catalog.song_index.features, np.memmap)
+        assert [song["id"] for song in response.json()] == ["b", "c"]
+    finally:
+        catalog.song_index, catalog.album_index = old
+        cache.recommendations.clear()
+
+
+def test_catalog_status(songs: songs):
+    response = client.get("/debug/catalog")
+
+    assert response.status_code == 200
+    assert response.json()["songs"] == len(catalog.song_index)
+    assert response.json()["reloading"] is False
+
+
+def test_stream_from_database(songs: songs):
+    db = TestingSessionLocal()
+    count, id_length = crud.get_feature_row_count(db, models.Song)
+    chunks = crud.stream_feature_rows(db, models.Song, chunk=2)
+    arrays = snapshot.from_rows(count, id_length, chunks)
+    db.close()
+
+    expected = snapshot.from_frame(pd.DataFrame(catalog_songs))
+    rows = index.SongIndex(**arrays).get_rows(songs)
+
+    assert len(arrays["ids"]) == count
+    assert arrays["ids"][rows].tolist() == expected["ids"].tolist()
+    assert np.allclose(arrays["features"][rows], expected["features"])
+    for column in snapshot.COLUMNS:
+        assert arrays[column][rows].tolist() == expected[column].tolist()
+
+
+def test_reload_database(songs: songs):
+    arrays = snapshot.from_frame(pd.DataFrame(catalog_songs))
+    old = catalog.song_index, catalog.album_index
+
+    try:
+        catalog.reload_database(lambda kind: arrays, lambda: ([], []))
+
+        assert len(catalog.song_index) == len(catalog_songs)
+        assert catalog.stage == catalog.STAGES.index("done")
+    finally:
+        catalog.song_index, catalog.album_index = old
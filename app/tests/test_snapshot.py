@@ -0,0 +1,128 @@
+import os
+
+import numpy as np
+import pandas as pd
+from pytest import fixture
+
+from app.recommender import engine, snapshot
+
+from .test_recommend import catalog_songs
+
+
+@fixture
+def csv(tmp_path):
+    file = tmp_path / "songs.csv"
+    pd.DataFrame(catalog_songs).to_csv(file, index=False)
+    return str(file)
+
+
+def test_build(csv, tmp_path):
+    directory = str(tmp_path / "snapshot")
+    arrays = snapshot.load_or_build([csv], directory)
+
+    assert arrays["ids"].tolist() == [song["id"].encode() for song in catalog_songs]
+    assert arrays["features"].dtype == np.float32
+    assert arrays["features"].shape == (len(catalog_songs), 10)
+    assert len(os.listdir(directory)) == 1
+
+
+def test_build_kinds(csv, tmp_path, monkeypatch):
+    directory = str(tmp_path / "snapshot")
+    reads = []
+    read_csvs = snapshot.read_csvs
+    monkeypatch.setattr(
+        snapshot, "read_csvs", lambda files: reads.append(files) or read_csvs(files)
+    )
+
+    targets = snapshot.build([csv], directory)
+
+    assert [snapshot.read_manifest(target)["kind"] for target in targets] == [
+        "songs",
+        "albums",
+    ]
+    assert len(reads) == 1
+
+
+def test_build_codes(csv, tmp_path):
+    directory = str(tmp_path / "snapshot")
+    codes = snapshot.load_or_build_codes([csv], directory, "int8")
+    songs = snapshot.load_or_build([csv], directory)
+    expected = engine.quantize(songs["features"], "int8")
+
+    assert codes["codes"].dtype == np.int8
+    assert codes["codes"].tolist() == expected[0].tolist()
+    assert np.allclose(codes["scale"], expected[1])
+    assert np.allclose(codes["offset"], expected[2])
+    assert sorted(os.listdir(directory))[0].startswith("codes-int8-")
+
+
+def test_build_albums(csv, tmp_path):
+    directory = str(tmp_path / "snapshot")
+    songs = snapshot.load_or_build([csv], directory)
+    albums = snapshot.load_or_build([csv], directory, kind="albums")
+
+    assert albums["ids"].tolist() == [b"catalog"]
+    assert albums["explicit"].tolist() == [True]
+    assert albums["year"].tolist() == [2020]
+    assert len(songs["ids"]) == len(catalog_songs)
+    assert len(os.listdir(directory)) == 2
+
+
+def test_albums_from_frame():
+    songs = pd.DataFrame(catalog_songs).assign(
+        album_id=["x", "x", "x", "y", "y", "y"], key=[1, 2, 2, 7, 3, 3]
+    )
+    albums = snapshot.albums_from_frame(songs)
+    features = songs.groupby("album_id")[engine.FEATURES].mean()
+    features["key"] = [2, 3]
+
+    assert albums["ids"].tolist() == [b"x", b"y"]
+    assert albums["key"].tolist() == [2, 3]
+    assert albums["year"].tolist() == [2020, 2020]
+    assert albums["explicit"].tolist() == [True, False]
+    assert np.allclose(albums["features"], engine.normalize(features.to_numpy()))
+
+
+def test_from_rows():
+    rows = [
+        ("a", *range(len(engine.FEATURES)), 2001, True, 5, 1, 4),
+        ("bb", *range(len(engine.FEATURES)), 2002, None, 6, 0, 3),
+        ("c", *range(len(engine.FEATURES)), 2003, False, 7, 1, 4),
+    ]
+    arrays = snapshot.from_rows(2, 2, [rows[:1], rows[1:]])
+
+    assert arrays["ids"].tolist() == [b"a", b"bb"]
+    assert arrays["features"].shape == (2, len(engine.FEATURES))
+    assert arrays["explicit"].tolist() == [True, False]
+    assert arrays["year"].tolist() == [2001, 2002]
+    assert arrays["order"].tolist() == [0, 1]
+
+
+def test_load_current(csv, tmp_path):
+    directory = str(tmp_path / "snapshot")
+    snapshot.load_or_build([csv], directory)
+    ids = os.path.join(snapshot.path(directory, snapshot.checksum([csv])), "ids.npy")
+    modified = os.path.getmtime(ids)
+
+    arrays = snapshot.load_or_build([csv], directory)
+
+    assert os.path.getmtime(ids) == modified
+    assert len(arrays["ids"]) == len(catalog_songs)
+
+
+def test_load_mmap(csv, tmp_path):
+    arrays = snapshot.load_or_build([csv], str(tmp_path / "snapshot"), mmap=True)
+
+    assert isinstance(arrays["features"], np.memmap)
+    assert not arrays["features"].flags.writeable
+
+
+def test_rebuild_on_change(csv, tmp_path):
+    directory = str(tmp_path / "snapshot")
+    snapshot.load_or_build([csv], directory)
+
+    pd.DataFrame(catalog_songs[:3]).to_csv(csv, index=False)
+    arrays = snapshot.load_or_build([csv], directory)
+
+    assert len(arrays["ids"]) == 3
+    assert len(os.listdir(directory)) == 1
@@ -0,0 +1,48 @@
+import numpy as np
+
+from app.recommender import benchmark, engine, taste
+from app.sql import models
+
+
+def test_update():
+    vectors = engine.normalize(np.random.default_rng(0).random((3, 10)))
+    profile = models.TasteProfile(count=0)
+
+    taste.update(profile, list(vectors))
+    assert profile.count == 3
+    assert np.allclose(taste.centroid(profile), engine.combine(vectors))
+
+    taste.update(profile, [vectors[1]], -1)
+    assert profile.count == 2
+    assert np.allclose(taste.centroid(profile), engine.combine(vectors[[0, 2]]))
+
+    taste.update(profile, [vectors[0], vectors[2]], -1)
+    assert profile.count == 0
+    assert taste.centroid(profile) is None
+    assert not taste.read_sum(profile).any()
+
+
+def profile_of(vectors: np.ndarray):
+    profile = models.TasteProfile(count=0)
+    taste.update(profile, list(vectors))
+    return profile
+
+
+def test_similarities():
+    features = engine.normalize(benchmark.synthetic(10000))
+    mean, std = features.mean(axis=0), features.std(axis=0)
+    # Acoustic and electronic songs, every other one in each of two profiles
+    order = np.argsort(features[:, engine.FEATURES.index("acousticness")])
+    electronic, also_electronic = (profile_of(features[order[i:200:2]]) for i in [0, 1])
+    acoustic = profile_of(features[order[-100:]])
+    empty = models.TasteProfile(count=0)
+
+    raw = taste.centroid(electronic) @ taste.centroid(acoustic)
+    similar, different, none = taste.similarities(
+        electronic, [also_electronic, acoustic, empty], mean, std
+    )
+
+    assert raw > 0.99
+    assert similar > 0.9
+    assert different < 0
+    assert none is None
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 
 
@@ -8,6 +10,48 @@ class Settings(BaseSettings):
     access_token_expire_minutes: int = 30
     sqlalchemy_database_url: str = "sqlite:///./sql.db"
     songfiles: list = ["songs_0.csv", "songs_1.csv", "songs_2.csv", "songs_3.csv"]
+    # "csv" loads the catalog from snapshots of songfiles, "database" streams
+    # the songs and albums tables
+    catalog_source: Literal["csv", "database"] = "csv"
+    snapshot_dir: str = "snapshot"
+    # Seconds clients are told to wait while the catalog loads
+    catalog_retry_after: int = 5
+    # Memory map the snapshot so all workers on a host share one copy
+    snapshot_mmap: bool = False
+    # "exact" scans the whole catalog, "ivf" only the nearest inverted lists
+    recommend_index: Literal["exact", "ivf"] = "exact"
+    ivf_lists: int = 0
+    ivf_nprobe: int = 16
+    # Exact scans are split into this many shards scored on as many threads
+    recommend_shards: int = 1
+    # Scans of CSV catalogs read int16 or int8 codes stored next to the song
+    # snapshot, re-scoring the best recommend_rerank * k rows with memory
+    # mapped float32 features, 0 keeps the quantized scores
+    recommend_precision: Literal["float32", "int16", "int8"] = "float32"
+    recommend_rerank: int = 16
+    # Songs added after startup are merged into the main index at this size
+    delta_merge_size: int = 1000
+    # Single seed searches arriving within the window are scored together,
+    # 0 disables batching
+    recommend_batch_window_ms: float = 0
+    recommend_batch_size: int = 32
+    # Width of the neighbour table built by app.recommender.neighbours,
+    # computed in this many processes, 0 starts one per core
+    neighbour_count: int = 10
+    neighbour_workers: int = 2
+    # Seconds between rebuilds of the collaborative similarities after star
+    # or playlist changes, 0 disables them
+    collaborative_interval: float = 300
+    # Songs taken from each of audio and collaborative similarity when blending
+    collaborative_candidates: int = 100
+    # Cached recommendation lists, 0 disables the cache
+    recommend_cache_size: int = 4096
+    recommend_cache_ttl: float = 600
+    # Paged recommendations rank this many songs on the first page and keep
+    # them for later pages under a cursor, 0 cursor size disables paging
+    recommend_page_depth: int = 500
+    recommend_cursor_size: int = 1024
+    recommend_cursor_ttl: float = 600
 
 
 settings = Settings()
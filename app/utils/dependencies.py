@@ -18,6 +18,7 @@ def get_db():
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/sign_in")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/sign_in", auto_error=False)
 
 
 async def get_current_user(
@@ -35,3 +36,13 @@ async def get_current_user(
     if not user:
         raise credentials_exception
     return user
+
+
+async def get_optional_user(
+    token: Annotated[str | None, Depends(optional_oauth2_scheme)],
+    db: Session = Depends(get_db),
+):
+    """Returns the signed in user, or None for anonymous requests."""
+    if token is None:
+        return None
+    return await get_current_user(token, db)
@@ -0,0 +1,31 @@
+import os
+
+
+def memory_usage() -> dict:
+    """Returns the resident, shared and private memory of this process in bytes.
+
+    Proportional set size (pss) splits shared pages evenly between the processes
+    mapping them, so summing it over all workers gives the real host usage.
+    Outside of Linux only the peak resident size is available.
+    """
+    usage = {"pid": os.getpid()}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(
+                line.split(":", 1) for line in f if ":" in line and line[0].isupper()
+            )
+    except OSError:
+        import resource
+
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage["max_rss"] = maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+        return usage
+
+    def size(*names):
+        return sum(int(fields[name].split()[0]) * 1024 for name in names)
+
+    usage["rss"] = size("Rss")
+    usage["pss"] = size("Pss")
+    usage["shared"] = size("Shared_Clean", "Shared_Dirty")
+    usage["private"] = size("Private_Clean", "Private_Dirty")
+    return usage